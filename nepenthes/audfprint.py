@@ -16,6 +16,8 @@ import docopt
 import os
 # For __main__
 import sys
+# For merge
+import itertools
 # For multiprocessing options
 import multiprocessing  # for new/add
 import joblib           # for match
@@ -86,11 +88,11 @@ def file_precompute_peaks_or_hashes(analyzer, filename, precompdir,
       if hashes_not_peaks:
         type = "hashes"
         saver = audfprint_analyze.hashes_save
-        output = analyzer.wavfile2hashes(filename)
+        output, dur = analyzer.wavfile2hashes(filename, return_dur=True)
       else:
         type = "peaks"
         saver = audfprint_analyze.peaks_save
-        output = analyzer.wavfile2peaks(filename)
+        output, dur = analyzer.wavfile2peaks(filename, return_dur=True)
       # save the hashes or peaks file
       if len(output) == 0:
         message = "Zero length analysis for " + filename + " -- not saving."
@@ -100,7 +102,7 @@ def file_precompute_peaks_or_hashes(analyzer, filename, precompdir,
         # Write the file
         saver(opfname, output)
         message = ("wrote " + opfname + " ( %d %s, %.3f sec)" \
-                   % (len(output), type, analyzer.soundfiledur))
+                   % (len(output), type, dur))
       return [message]
 
 def file_precompute(analyzer, filename, precompdir, type='peaks', skip_existing=False, strip_prefix=None):
@@ -113,36 +115,50 @@ def file_precompute(analyzer, filename, precompdir, type='peaks', skip_existing=
                                            skip_existing=skip_existing,
                                            strip_prefix=strip_prefix)
 
-def make_ht_from_list(analyzer, filelist, hashbits, depth, maxtime, pipe=None):
-    """ Populate a hash table from a list, used as target for
-        multiprocess division.  pipe is a pipe over which to push back
-        the result, else return it """
-    # Create new ht instance
-    ht = hash_table.HashTable(hashbits=hashbits, depth=depth, maxtime=maxtime)
-    # Add in the files
-    for filename in filelist:
-        hashes = analyzer.wavfile2hashes(filename)
-        ht.store(filename, hashes)
-    # Pass back to caller
-    if pipe:
-        pipe.send(ht)
-    else:
-        return ht
+def auto_size(args, report):
+    """ Choose hashbits and depth for a new dbase from the options """
+    nhashes = (float(args['--auto-size']) * float(args['--density'])
+               * int(args['--fanout']) * max(1, int(args['--shifts'])))
+    max_bytes = None
+    if args['--max-memory']:
+        max_bytes = float(args['--max-memory']) * 1e6
+    entrybits = int(args['--entrybits'])
+    hashbits, depth, dropped = hash_table.choose_size(
+        nhashes, float(args['--max-dropped']), max_bytes,
+        entrybits=entrybits)
+    report(["Auto-size for about %d hashes: hashbits %d, bucketsize %d, "
+            "%.1f MB, %.2f%% expected dropped"
+            % (nhashes, hashbits, depth,
+               1e-6 * (1 << hashbits) * (entrybits // 8 * depth + 4),
+               100.0 * dropped)])
+    return hashbits, depth
+
+def load_merge_tables(hash_tab, filename_iter):
+    """ Iterator to read each of the hash tables to merge into hash_tab
+        in turn, checking they match its samplerate """
+    for filename in filename_iter:
+        hash_tab2 = hash_table.HashTable(filename)
+        if "samplerate" in hash_tab.params:
+            assert hash_tab.params["samplerate"] == hash_tab2.params["samplerate"]
+        else:
+            # "newmerge" fails to setup the samplerate param
+            hash_tab.params["samplerate"] = hash_tab2.params["samplerate"]
+        yield hash_tab2
 
-def do_cmd(cmd, analyzer, hash_tab, filename_iter, matcher, outdir, type, report, skip_existing=False, strip_prefix=None):
+def do_cmd(cmd, analyzer, hash_tab, filename_iter, matcher, outdir, type, report, skip_existing=False, strip_prefix=None, checkpoint=None, merge_batch=None):
     """ Breaks out the core part of running the command.
         This is just the single-core versions.
+        checkpoint, if given, is called after each file is added.
+        merge_batch limits how many dbases merge reads in at once.
     """
     if cmd == 'merge' or cmd == 'newmerge':
-        # files are other hash tables, merge them in
-        for filename in filename_iter:
-            hash_tab2 = hash_table.HashTable(filename)
-            if "samplerate" in hash_tab.params:
-                assert hash_tab.params["samplerate"] == hash_tab2.params["samplerate"]
-            else:
-                # "newmerge" fails to setup the samplerate param
-                hash_tab.params["samplerate"] = hash_tab2.params["samplerate"]
-            hash_tab.merge(hash_tab2)
+        # files are other hash tables, merge them in.  Pairwise trees
+        # of merges, in parallel, of merge_batch tables at a time,
+        # ending up in hash_tab
+        hash_table.merge_tables(
+            itertools.chain([hash_tab],
+                            load_merge_tables(hash_tab, filename_iter)),
+            maxtables=merge_batch)
 
     elif cmd == 'precompute':
         # just precompute fingerprints, single core
@@ -166,59 +182,102 @@ def do_cmd(cmd, analyzer, hash_tab, filename_iter, matcher, outdir, type, report
             dur, nhash = analyzer.ingest(hash_tab, filename)
             tothashes += nhash
             ix += 1
+            if checkpoint:
+                checkpoint()
 
         report(["Added " +  str(tothashes) + " hashes "
-                + "(%.1f" % (tothashes/float(analyzer.soundfiletotaldur))
+                + "(%.1f" % (tothashes/max(1e-3, analyzer.soundfiletotaldur))
                 + " hashes/sec)"])
     elif cmd == 'remove':
-        # Removing files from hash table.
-        for filename in filename_iter:
-            hash_tab.remove(filename)
+        # Removing files from hash table, all in one pass.
+        hash_tab.remove(list(filename_iter))
 
     elif cmd == 'list':
         hash_tab.list(lambda x: report([x]))
 
+    elif cmd == 'stats':
+        hash_tab.print_stats(lambda x: report([x]))
+
+    elif cmd == 'compact':
+        # load() already replayed the journal; saving folds it in.
+        hash_tab.dirty = True
+
     else:
         raise ValueError("unrecognized command: "+cmd)
 
-def multiproc_add(analyzer, hash_tab, filename_iter, report, ncores):
-    """Run multiple threads adding new files to hash table"""
-    # run ncores in parallel to add new files to existing HASH_TABLE
-    # lists store per-process parameters
-    # Pipes to transfer results
-    rx = [[] for _ in range(ncores)]
-    tx = [[] for _ in range(ncores)]
-    # Process objects
-    pr = [[] for _ in range(ncores)]
-    # Lists of the distinct files
-    filelists = [[] for _ in range(ncores)]
-    # unpack all the files into ncores lists
-    ix = 0
+# The analyzer in each ingest worker process, see multiproc_add
+worker_analyzer = None
+
+def init_ingest_worker(analyzer):
+    """ Give an ingest worker process its analyzer """
+    global worker_analyzer
+    worker_analyzer = analyzer
+
+def ingest_worker_hashes(filename):
+    """ Calculate the hashes for one file in an ingest worker process """
+    hashes, dur = worker_analyzer.wavfile2hashes(filename, return_dur=True)
+    return filename, hashes, dur
+
+def file_size(filename):
+    """ Size of a file in bytes, or 0 if it can't be read """
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+def multiproc_add(analyzer, hash_tab, filename_iter, report, ncores,
+                  largest_first=True, checkpoint=None):
+    """Run multiple processes adding new files to hash table.  Each worker
+       takes the next file from a shared queue whenever it is free, and
+       passes back just that file's hashes, which are stored in the table
+       as they arrive.  With largest_first, the biggest files go first so
+       that a long file doesn't leave one worker running on its own at
+       the end.  checkpoint, if given, is called after each file is
+       stored."""
+    filenames = list(filename_iter)
+    if largest_first:
+        filenames.sort(key=file_size, reverse=True)
+    tothashes = 0
+    with multiprocessing.Pool(ncores, init_ingest_worker,
+                              (analyzer,)) as pool:
+        # chunksize 1 hands out files one at a time
+        for ix, (filename, hashes, dur) in enumerate(
+                pool.imap_unordered(ingest_worker_hashes, filenames, 1)):
+            hash_tab.store(filename, hashes)
+            # Keep the totals a single process would have
+            analyzer.stats.add(dur)
+            tothashes += len(hashes)
+            report([time.ctime() + " ingested #" + str(ix) + ": "
+                    + filename + " (" + str(len(hashes)) + " hashes)"])
+            if checkpoint:
+                checkpoint()
+    report(["Added " + str(tothashes) + " hashes "
+            + "(%.1f" % (tothashes/max(1e-3, analyzer.soundfiletotaldur))
+            + " hashes/sec)"])
+
+
+def make_checkpoint(hash_tab, dbasename, interval, report):
+    """ Return a function to call after each file is added, which saves
+        the dbase if interval seconds have passed since it was last saved.
+        The saved dbase lists the files added so far, which is what
+        --resume skips. """
+    last_save = [time.time()]
+    def checkpoint():
+        # Journaled changes are already on disk as they are made
+        if (hash_tab.dirty and not hash_tab.journal_file
+                and time.time() - last_save[0] >= interval):
+            report([time.ctime() + " checkpointing " + dbasename])
+            hash_tab.save(dbasename)
+            last_save[0] = time.time()
+    return checkpoint
+
+def skip_ingested(hash_tab, filename_iter, report):
+    """ Iterate over the filenames not already in the hash table """
     for filename in filename_iter:
-        filelists[ix % ncores].append(filename)
-        ix += 1
-    # Launch each of the individual processes
-    for ix in range(ncores):
-        rx[ix], tx[ix] = multiprocessing.Pipe(False)
-        pr[ix] = multiprocessing.Process(target=make_ht_from_list,
-                                         args=(analyzer, filelists[ix],
-                                               hash_tab.hashbits,
-                                               hash_tab.depth,
-                                               (1<<hash_tab.maxtimebits),
-                                               tx[ix]))
-        pr[ix].start()
-    # gather results when they all finish
-    for core in range(ncores):
-        # thread passes back serialized hash table structure
-        hash_tabx = rx[core].recv()
-        report(["hash_table " + str(core) + " has "
-                + str(len(hash_tabx.names))
-                + " files " + str(sum(hash_tabx.counts)) + " hashes"])
-        # merge in all the new items, hash entries
-        hash_tab.merge(hash_tabx)
-        # finish that thread...
-        pr[core].join()
-
+        if filename in hash_tab.name_ids:
+            report(["Skipping " + filename + " (already in dbase)"])
+        else:
+            yield filename
 
 def matcher_file_match_to_msgs(matcher, analyzer, hash_tab, filename):
     """Cover for matcher.file_match_to_msgs so it can be passed to joblib"""
@@ -227,7 +286,7 @@ def matcher_file_match_to_msgs(matcher, analyzer, hash_tab, filename):
 
 def do_cmd_multiproc(cmd, analyzer, hash_tab, filename_iter, matcher,
                      outdir, type, report, skip_existing=False,
-                     strip_prefix=None, ncores=1):
+                     strip_prefix=None, ncores=1, checkpoint=None):
     """ Run the actual command, using multiple processors """
     if cmd == 'precompute':
         # precompute fingerprints with joblib
@@ -254,7 +313,8 @@ def do_cmd_multiproc(cmd, analyzer, hash_tab, filename_iter, matcher,
     elif cmd == 'new' or cmd == 'add':
         # We add by forking multiple parallel threads each running
         # analyzers over different subsets of the file list
-        multiproc_add(analyzer, hash_tab, filename_iter, report, ncores)
+        multiproc_add(analyzer, hash_tab, filename_iter, report, ncores,
+                      checkpoint=checkpoint)
 
     else:
         # This is not a multiproc command
@@ -280,6 +340,7 @@ def setup_analyzer(args):
         # Default shift is 4 for match, otherwise 1
         analyzer.shifts = 4 if args['match'] else 1
     analyzer.fail_on_error = not args['--continue-on-error']
+    analyzer.streaming = args['--stream']
     return analyzer
 
 # Command to separate out setting of matcher parameters
@@ -326,9 +387,35 @@ or identify noisy query excerpts with "match".
 with precomputed fingerprint for each input wav file.
 "merge" combines previously-created databases into
 an existing database; "newmerge" combines existing
-databases to create a new one.
-
-Usage: audfprint (new | add | match | precompute | merge | newmerge | list | remove) [options] [<file>]...
+databases to create a new one.  They hold the dbase
+being built plus up to --merge-batch of the others in
+memory at once; fewer take less memory, but more run
+more of the merging in parallel.
+A dbase name ending in .fpmm is saved uncompressed so
+that it can be memory-mapped when it is read back; one
+ending in .fpcz is compressed in parallel blocks, and
+one ending in .fpsz holds only the occupied buckets.
+With --journal, "add" and "remove" append their changes
+to a journal next to the dbase instead of rewriting it;
+"compact" folds the journal back into the dbase.
+With --stream, audio is analyzed a minute at a time, so
+recordings too long to fit in memory can be added or
+matched (they are decoded to a temporary file first).
+After a "new" or "add" with --checkpoint is interrupted,
+rerun it with --resume to add just the remaining files.
+A new dbase holds 2^(entrybits - maxtimebits) - 1 files;
+for reference recordings longer than maxtime x 23 ms,
+raise --maxtimebits and use --entrybits 64.
+"stats" reports how full the dbase buckets are and
+how much memory the dbase takes.  With --auto-size,
+"new" picks the hashbits and bucketsize from the
+total duration of the audio to be added, assuming
+density x fanout x max(1, shifts) hashes per second.
+The --stop-count option sets how common a hash can be
+before matching ignores it (0 for no limit); it is
+saved with the dbase, except by "match" and "stats".
+
+Usage: audfprint (new | add | match | precompute | merge | newmerge | list | remove | compact | stats) [options] [<file>]...
 
 Options:
   -d <dbase>, --dbase <dbase>     Fingerprint database file
@@ -337,6 +424,7 @@ Options:
   -b <val>, --bucketsize <val>    Number of entries per bucket [default: 100]
   -t <val>, --maxtime <val>       Largest time value stored [default: 16384]
   -u <val>, --maxtimebits <val>   maxtime as a number of bits (16384 == 14 bits)
+  -E <bits>, --entrybits <bits>   Bits per stored id and time, 32 or 64 [default: 32]
   -r <val>, --samplerate <val>    Resample input files to this [default: 11025]
   -p <dir>, --precompdir <dir>    Save precomputed files under this dir [default: .]
   -i <val>, --shifts <val>        Use this many subframe shifts building fp [default: 0]
@@ -351,10 +439,21 @@ Options:
   -P <val>, --pks-per-frame <val>  Maximum number of peaks per frame [default: 5]
   -D <val>, --search-depth <val>  How far down to search raw matching track list [default: 100]
   -H <val>, --ncores <val>        Number of processes to use [default: 1]
+  --merge-batch <n>               Dbases merge holds in memory at once [default: 4]
   -o <name>, --opfile <name>      Write output (matches) to this file, not stdout [default: ]
   -K, --precompute-peaks          Precompute just landmarks (else full hashes)
+  -Z, --freeze                    Save the dbase in the compact read-only layout
+  --id-index                      Keep a per-file index of buckets (faster remove)
+  -j, --journal                   Journal add/remove changes instead of saving dbase
+  --checkpoint <secs>             Save the dbase this often during new/add
+  --resume                        Skip files already in the dbase (continue new/add)
+  -Y <n>, --stop-count <n>        Skip buckets offered more than n hashes when matching
+  -A <secs>, --auto-size <secs>   Size a new dbase for this much audio (ignores -h, -b)
+  --max-dropped <frac>            Fraction of hashes auto-size may drop [default: 0.01]
+  --max-memory <MB>               Memory auto-size may use for the table
   -k, --skip-existing             On precompute, skip items if output file already exists
   -C, --continue-on-error         Keep processing despite errors reading input
+  --stream                        Analyze audio in chunks, for very long files
   -l, --list                      Input files are lists, not audio
   -T, --sortbytime                Sort multiple hits per file by time (instead of score)
   -v <val>, --verbose <val>       Verbosity level [default: 1]
@@ -375,7 +474,7 @@ def main(argv):
 
     # Figure which command was chosen
     poss_cmds = ['new', 'add', 'precompute', 'merge', 'newmerge', 'match',
-                 'list', 'remove']
+                 'list', 'remove', 'compact', 'stats']
     cmdlist = [cmdname
                for cmdname in poss_cmds
                if args[cmdname]]
@@ -399,26 +498,36 @@ def main(argv):
 
     # Setup the analyzer if we're using one (i.e., unless "merge")
     analyzer = setup_analyzer(args) if not (
-        cmd is "merge" or cmd is "newmerge"
-        or cmd is "list" or cmd is "remove") else None
+        cmd == "merge" or cmd == "newmerge"
+        or cmd == "list" or cmd == "remove" or cmd == "compact"
+        or cmd == "stats") else None
 
     precomp_type = 'hashes'
 
     # Set up the hash table, if we're using one (i.e., unless "precompute")
-    if cmd is not "precompute":
+    if cmd != "precompute":
         # For everything other than precompute, we need a database name
         # Check we have one
         dbasename = args['--dbase']
         if not dbasename:
             raise ValueError("dbase name must be provided if not precompute")
-        if cmd == "new" or cmd == "newmerge":
+        if cmd == "new" and args['--resume'] and os.path.exists(dbasename):
+            # Pick up the checkpoint of an interrupted "new"
+            report([time.ctime() + " Resuming " + dbasename])
+            hash_tab = hash_table.HashTable(dbasename)
+        elif cmd == "new" or cmd == "newmerge":
             # Check that the output directory can be created before we start
             ensure_dir(os.path.split(dbasename)[0])
+            hashbits = int(args['--hashbits'])
+            depth = int(args['--bucketsize'])
+            if args['--auto-size'] and cmd == "new":
+                hashbits, depth = auto_size(args, report)
             # Create a new hash table
             hash_tab = hash_table.HashTable(
-                hashbits=int(args['--hashbits']),
-                depth=int(args['--bucketsize']),
-                maxtime=(1 << int(args['--maxtimebits'])))
+                hashbits=hashbits,
+                depth=depth,
+                maxtime=(1 << int(args['--maxtimebits'])),
+                entrybits=int(args['--entrybits']))
             # Set its samplerate param
             if analyzer:
                 hash_tab.params['samplerate'] = analyzer.target_sr
@@ -427,11 +536,26 @@ def main(argv):
             # Load existing hash table file (add, match, merge)
             if args['--verbose']:
                 report([time.ctime() + " Reading hash table " + dbasename])
-            hash_tab = hash_table.HashTable(dbasename)
+            # "list" only needs the names, so leave the table on disk
+            hash_tab = hash_table.HashTable(dbasename, lazy=(cmd == "list"))
             if analyzer and 'samplerate' in hash_tab.params \
                    and hash_tab.params['samplerate'] != analyzer.target_sr:
                 # analyzer.target_sr = hash_tab.params['samplerate']
                 print("db samplerate overridden to ", analyzer.target_sr)
+        if args['--stop-count'] is not None:
+            stop_count = int(args['--stop-count']) or None
+            if cmd == "match" or cmd == "stats":
+                # Just for this run
+                hash_tab.stop_count = stop_count
+            else:
+                # Saved with the dbase
+                hash_tab.set_stop_count(stop_count)
+        if args['--id-index'] and hash_tab.id_buckets is None:
+            # Index is saved along with the table next time it is written
+            hash_tab.build_index()
+        if args['--journal'] and (cmd == "add" or cmd == "remove"):
+            # Record the changes next to the dbase rather than rewriting it
+            hash_tab.open_journal(dbasename)
     else:
         # The command IS precompute
         # dummy empty hash table
@@ -444,6 +568,13 @@ def main(argv):
 
     filename_iter = filename_list_iterator(
         args['<file>'], args['--wavdir'], args['--wavext'], args['--list'])
+    checkpoint = None
+    if cmd == "new" or cmd == "add":
+        if args['--resume']:
+            filename_iter = skip_ingested(hash_tab, filename_iter, report)
+        if args['--checkpoint']:
+            checkpoint = make_checkpoint(hash_tab, dbasename,
+                                         float(args['--checkpoint']), report)
 
     #######################
     # Run the main commmand
@@ -452,19 +583,21 @@ def main(argv):
     # How many processors to use (multiprocessing)
     ncores = int(args['--ncores'])
     if ncores > 1 and not (cmd == "merge" or cmd == "newmerge" or
-                           cmd == "list" or cmd == "remove"):
-        # merge/newmerge/list/remove are always single-thread processes
+                           cmd == "list" or cmd == "remove" or
+                           cmd == "compact" or cmd == "stats"):
+        # merge/newmerge/list/remove/compact/stats are always single-thread
         do_cmd_multiproc(cmd, analyzer, hash_tab, filename_iter,
                          matcher, args['--precompdir'],
                          precomp_type, report,
                          skip_existing=args['--skip-existing'],
                          strip_prefix=args['--wavdir'],
-                         ncores=ncores)
+                         ncores=ncores, checkpoint=checkpoint)
     else:
         do_cmd(cmd, analyzer, hash_tab, filename_iter,
                matcher, args['--precompdir'], precomp_type, report,
                skip_existing=args['--skip-existing'],
-               strip_prefix=args['--wavdir'])
+               strip_prefix=args['--wavdir'], checkpoint=checkpoint,
+               merge_batch=int(args['--merge-batch']))
 
     elapsedtime = time.clock() - initticks
     if analyzer and analyzer.soundfiletotaldur > 0.:
@@ -472,8 +605,14 @@ def main(argv):
         print(log_format.format(analyzer.soundfilecount, analyzer.soundfiletotaldur,
                                 elapsedtime, (elapsedtime / analyzer.soundfiletotaldur)))
 
+    # Journaled changes are already on disk
+    if hash_tab:
+        hash_tab.close_journal()
+
     # Save the hash table file if it has been modified
     if hash_tab and hash_tab.dirty:
+        if args['--freeze']:
+            hash_tab.freeze()
         # We already created the directory, if "new".
         hash_tab.save(dbasename)
 
@@ -9,9 +9,17 @@ Class to do the analysis of wave files into hash constellations.
 from __future__ import print_function
 
 import os
+import tempfile
+import threading
+import concurrent.futures
 import numpy as np
 
 import scipy.signal
+try:
+    # Keeps float32 in single precision; scipy >= 1.4
+    from scipy.fft import rfft
+except ImportError:
+    from numpy.fft import rfft
 
 # For reading/writing hashes to file
 import struct
@@ -23,8 +31,6 @@ import time
 # For utility, glob2hashtable
 from audfprint import hash_table
 
-import librosa
-
 from audfprint import audio_read
 
 ################ Globals ################
@@ -39,11 +45,13 @@ def locmax(vec, indices=False):
         End points are peaks if larger than single neighbors.
         if indices=True, return the indices of the True values instead
         of the boolean vector.
+        A 2-D vec is treated as a set of column vectors, giving a boolean
+        array of the local maxima down each column.
     """
     # vec[-1]-1 means last value can be a peak
     #nbr = np.greater_equal(np.r_[vec, vec[-1]-1], np.r_[vec[0], vec])
     # the np.r_ was killing us, so try an optimization...
-    nbr = np.zeros(len(vec)+1, dtype=bool)
+    nbr = np.zeros((len(vec)+1,) + np.shape(vec)[1:], dtype=bool)
     nbr[0] = True
     nbr[1:-1] = np.greater_equal(vec[1:], vec[:-1])
     maxmask = (nbr[:-1] & ~nbr[1:])
@@ -53,6 +61,15 @@ def locmax(vec, indices=False):
         return maxmask
 
 # Constants for Analyzer
+# Samples are fed to a StreamingAnalyzer in chunks of about this many seconds
+STREAM_CHUNK_SECS = 60
+# What audio_read raises for files it can't read (as opposed to bugs)
+AUDIO_READ_ERRORS = (IOError, OSError, ValueError, NotImplementedError)
+# Threads analyzing the sub-frame shifts of one file at once.  Only the
+# FFTs and filtering release the GIL, and under gevent or alongside
+# worker processes the threads just compete for CPU, so by default the
+# shifts run in turn; see benchmark_analyze before raising it.
+SHIFT_THREADS = 1
 # DENSITY controls the density of landmarks found (approx DENSITY per sec)
 DENSITY = 20.0
 # OVERSAMP > 1 tries to generate extra landmarks by decaying faster
@@ -83,7 +100,7 @@ def landmarks2hashes(landmarks):
     into a list of (time, hash) pairs where the hash combines
     the three remaining values.
     """
-    landmarks = np.array(landmarks)
+    landmarks = np.array(landmarks).reshape(-1, 4)
     hashes = np.zeros((landmarks.shape[0], 2), dtype=np.int32)
     hashes[:, 0] = landmarks[:, 0]
     hashes[:, 1] = (((landmarks[:, 1] & B1_MASK) << B1_SHIFT)
@@ -93,6 +110,19 @@ def landmarks2hashes(landmarks):
     return hashes
 
 
+def unique_hashes(hashes):
+    """Return the distinct (time, hash) rows of an array of them, sorted."""
+    # Remove duplicates by merging each row into a single value.
+    hashes_hashes = (((hashes[:, 0].astype(np.uint64)) << 32)
+                     + hashes[:, 1].astype(np.uint64))
+    unique_hash_hash = np.sort(np.unique(hashes_hashes))
+    return np.hstack([
+        (unique_hash_hash >> 32)[:, np.newaxis],
+        (unique_hash_hash & ((1<<32) - 1))[:, np.newaxis]
+    ]).astype(np.int32)
+    # Or simply np.unique(hashes, axis=0) for numpy >= 1.13
+
+
 def hashes2landmarks(hashes):
     """Convert the mashed-up landmarks in hashes back into a list
     of (time, bin1, bin2, dtime) tuples.
@@ -109,16 +139,168 @@ def hashes2landmarks(hashes):
     return landmarks
 
 
+class Spectrogram(object):
+    """ Compute the enhanced log-magnitude spectrograms that find_peaks
+        looks for peaks in.  The window and filter coefficients are built
+        once per (n_fft, n_hop), and the whole calculation stays in dtype
+        (float32 by default), working in place where it can. """
+
+    def __init__(self, n_fft=N_FFT, n_hop=N_HOP, dtype=np.float32):
+        self.n_fft = n_fft
+        self.n_hop = int(n_hop)
+        self.dtype = np.dtype(dtype)
+        # As a column, to weight each frame of a (n_fft, frames) array
+        self.window = np.hanning(n_fft+2)[1:-1].astype(
+            self.dtype)[:, np.newaxis]
+        # High-pass filter onset emphasis
+        self.hpf_b = np.array([1, -1], dtype=self.dtype)
+        self.hpf_a = np.array([1, -(HPF_POLE)**(1/OVERSAMP)],
+                              dtype=self.dtype)
+
+    def stft_magnitude(self, d):
+        """ Return the magnitude of the STFT of waveform d as a
+            (n_fft/2+1, frames) array.  Frames are centered on multiples of
+            n_hop, with the ends padded by reflection (as librosa 0.5's
+            stft). """
+        return self.frames_magnitude(
+            np.pad(np.asarray(d, dtype=self.dtype), self.n_fft//2,
+                   mode='reflect'))
+
+    def frames_magnitude(self, d):
+        """ Return the STFT magnitudes of all the whole frames of d, which
+            start at multiples of n_hop, as a (n_fft/2+1, frames) array """
+        nframes = 1 + (len(d) - self.n_fft)//self.n_hop
+        if nframes <= 0:
+            return np.zeros((self.n_fft//2 + 1, 0), dtype=self.dtype)
+        # View of the overlapping frames as columns, without copying
+        frames = np.lib.stride_tricks.as_strided(
+            d, shape=(self.n_fft, nframes),
+            strides=(d.strides[0], d.strides[0]*self.n_hop))
+        return np.abs(rfft(frames*self.window, axis=0)).astype(
+            self.dtype, copy=False)
+
+    def __call__(self, d):
+        """ Return the log-magnitude spectrogram of waveform d, normalized
+            to zero mean and high-pass filtered along time, as a
+            (n_fft/2, frames) array; the top (nyquist) bin is discarded so
+            bins fit in 8 bits. """
+        return self.enhance(self.stft_magnitude(d))
+
+    def enhance(self, sgram):
+        """ Turn an STFT magnitude from stft_magnitude into the spectrogram
+            returned by __call__, overwriting it. """
+        sgrammax = np.max(sgram) if sgram.size else 0.0
+        if sgrammax > 0.0:
+            self.log_magnitude(sgram, sgrammax)
+            sgram -= self.dtype.type(np.mean(sgram, dtype=np.float64))
+        else:
+            # The sgram is identically zero, i.e., the input signal was identically
+            # zero.  Not good, but let's let it through for now.
+            print("find_peaks: Warning: input signal is identically zero.")
+        return scipy.signal.lfilter(self.hpf_b, self.hpf_a, sgram[:-1],
+                                    axis=1)
+
+    def log_magnitude(self, sgram, sgrammax):
+        """ Take the log of STFT magnitudes in place, with a floor 120 dB
+            below sgrammax, the largest magnitude in the spectrogram. """
+        np.maximum(sgram, sgrammax/1e6, out=sgram)
+        np.log(sgram, out=sgram)
+        return sgram
+
+
+class _StftStream(object):
+    """ Calculate the STFT magnitudes of a stream of samples, fed in
+        chunks, giving the same frames as Spectrogram.stft_magnitude of all
+        the samples together.  Only the samples of one unfinished frame are
+        kept between chunks. """
+
+    def __init__(self, spectrogram, skip=0):
+        self.spectrogram = spectrogram
+        # Number of initial samples to drop
+        self.skip = skip
+        # Samples not yet made into frames (including the start padding,
+        # once there are enough samples to make it)
+        self.buffer = np.zeros(0, dtype=spectrogram.dtype)
+        self.padded = False
+        # The last samples seen, for the end padding
+        self.tail = np.zeros(0, dtype=spectrogram.dtype)
+        self.nsamples = 0
+
+    def feed(self, samples):
+        """ Add samples to the stream; return the magnitudes of the frames
+            they complete, as a (n_fft/2+1, frames) array. """
+        spectrogram = self.spectrogram
+        samples = np.asarray(samples, dtype=spectrogram.dtype)
+        if self.skip:
+            skipped = min(self.skip, len(samples))
+            samples = samples[skipped:]
+            self.skip -= skipped
+        self.nsamples += len(samples)
+        halfwin = spectrogram.n_fft//2
+        self.tail = np.r_[self.tail, samples[-(halfwin + 1):]][-(halfwin + 1):]
+        self.buffer = np.r_[self.buffer, samples]
+        if not self.padded:
+            if len(self.buffer) <= halfwin:
+                return spectrogram.frames_magnitude(self.buffer[:0])
+            # Reflect the start, as np.pad(mode='reflect')
+            self.buffer = np.r_[self.buffer[halfwin:0:-1], self.buffer]
+            self.padded = True
+        return self._frames()
+
+    def finish(self):
+        """ Return the magnitudes of the remaining frames, after padding the
+            end of the stream. """
+        spectrogram = self.spectrogram
+        if not self.padded:
+            if len(self.buffer) == 0:
+                return spectrogram.frames_magnitude(self.buffer)
+            # Too short to have started; do it all at once
+            return spectrogram.stft_magnitude(self.buffer)
+        self.buffer = np.r_[self.buffer, self.tail[-2::-1]]
+        return self._frames()
+
+    def _frames(self):
+        """ Make frames from the whole frames in the buffer, keeping the
+            rest. """
+        spectrogram = self.spectrogram
+        mags = spectrogram.frames_magnitude(self.buffer)
+        self.buffer = self.buffer[mags.shape[1]*spectrogram.n_hop:]
+        return mags
+
+
+class AnalysisStats(object):
+    """ Running totals of the sound analyzed, which several threads may
+        add to at once """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totaldur = 0.0
+        self.count = 0
+
+    def add(self, dur, count=1):
+        """ Count count more files, with total duration dur """
+        with self.lock:
+            self.totaldur += dur
+            self.count += count
+
+    def __getstate__(self):
+        # Locks can't be pickled (e.g. to send to worker processes)
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
 class Analyzer(object):
     """ A class to wrap up all the parameters associated with
-        the analysis of soundfiles into fingerprints """
+        the analysis of soundfiles into fingerprints.  Analysis doesn't
+        change the parameters, so one Analyzer can be shared by threads
+        running analyses at once (numpy and the FFT release the GIL). """
     # Parameters
 
-    # optimization: cache pre-calculated Gaussian profile
-    __sp_width = None
-    __sp_len = None
-    __sp_vals = []
-
     def __init__(self, density=DENSITY):
         self.density = density
         self.target_sr = 11025
@@ -138,14 +320,51 @@ class Analyzer(object):
         self.mindt = 2
         # max lookahead in time (LIMITED TO <64 IN LANDMARK2HASH)
         self.targetdt = 63
-        # global stores duration of most recently-read soundfile
-        self.soundfiledur = 0.0
-        # .. and total amount of sound processed
-        self.soundfiletotaldur = 0.0
-        # .. and count of files
-        self.soundfilecount = 0
+        # total amount of sound processed, and count of files
+        self.stats = AnalysisStats()
+        # duration of the soundfile most recently read by each thread
+        self._local = threading.local()
         # Control behavior on file reading error
         self.fail_on_error = True
+        # wavfile2hashes analyzes soundfiles in chunks (see
+        # wavfile2hashes_streaming), for recordings too long for memory
+        self.streaming = False
+        # Spectrogram engine, made to match n_fft and n_hop by find_peaks
+        self.spectrogram = None
+        # Threads for the sub-frame shifts of one file (1 runs them in turn)
+        self.shift_threads = SHIFT_THREADS
+        # optimization: cache pre-calculated Gaussian profiles, by
+        # (npoints, width); they are read-only, so threads can share them
+        self._profiles = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def soundfiledur(self):
+        """ Duration of the soundfile most recently read by this thread """
+        return getattr(self._local, 'soundfiledur', 0.0)
+
+    @property
+    def soundfiletotaldur(self):
+        """ Total duration of the soundfiles read by all threads """
+        return self.stats.totaldur
+
+    @property
+    def soundfilecount(self):
+        """ Number of soundfiles read by all threads """
+        return self.stats.count
+
+    def _record_file(self, dur):
+        """ instrumentation to track total amount of sound processed """
+        self._local.soundfiledur = dur
+        self.stats.add(dur)
 
     def spreadpeaksinvector(self, vector, width=4.0):
         """ Create a blurred version of vector, where each of the local maxes
@@ -181,18 +400,26 @@ class Analyzer(object):
         #for pos, val in peaks:
         #   vec = np.maximum(vec, val*np.exp(-0.5*(((binvals - pos)
         #                                /float(width))**2)))
-        if width != self.__sp_width or npoints != self.__sp_len:
-            # Need to calculate new vector
-            self.__sp_width = width
-            self.__sp_len = npoints
-            self.__sp_vals = np.exp(-0.5*((np.arange(-npoints, npoints+1)
-                                           / float(width))**2))
+        sp_vals = self._gaussian_profile(npoints, width)
         # Now the actual function
         for pos, val in peaks:
-            vec = np.maximum(vec, val*self.__sp_vals[np.arange(npoints)
-                                                     + npoints - pos])
+            vec = np.maximum(vec, val*sp_vals[np.arange(npoints)
+                                              + npoints - pos])
         return vec
 
+    def _gaussian_profile(self, npoints, width):
+        """ A read-only Gaussian with SD width over -npoints..npoints,
+            cached for each npoints and width asked for. """
+        profile = self._profiles.get((npoints, width))
+        if profile is None:
+            # Need to calculate new vector; threads that race here just
+            # store the same values twice
+            profile = np.exp(-0.5*((np.arange(-npoints, npoints+1)
+                                    / float(width))**2))
+            profile.setflags(write=False)
+            self._profiles[(npoints, width)] = profile
+        return profile
+
     def _decaying_threshold_fwd_prune(self, sgram, a_dec):
         """ forward pass of findpeaks
             initial threshold envelope based on peaks in first 10 frames
@@ -201,54 +428,117 @@ class Analyzer(object):
         sthresh = self.spreadpeaksinvector(
             np.max(sgram[:, :np.minimum(10, scols)], axis=1), self.f_sd
         )
+        pkcols, pkposs = self._fwd_prune_columns(sgram, sthresh, a_dec)
+        # Filled in transposed, so each column is contiguous
+        peaks_t = np.zeros((scols, srows))
+        peaks_t[pkcols, pkposs] = 1
+        return peaks_t.T
+
+    def _fwd_prune_columns(self, sgram, sthresh, a_dec, firstcol=0):
+        """ Run the forward pass over the columns of sgram, starting from
+            threshold sthresh, which is left as it is after the last
+            column.  Return the peaks found as arrays of their columns
+            (numbering the first column of sgram as firstcol) and bins.
+        """
         ## Store sthresh at each column, for debug
         #thr = np.zeros((srows, scols))
-        peaks = np.zeros((srows, scols))
         # optimization of mask update
         __sp_pts = len(sthresh)
-        __sp_v = self.__sp_vals
+        __sp_v = self._gaussian_profile(__sp_pts, self.f_sd)
+        # Local maxima don't depend on the threshold, so find them for the
+        # whole spectrogram at once.  Work on the transposes, so each
+        # column is contiguous.
+        sgram_t = np.ascontiguousarray(sgram.T)
+        maxmask_t = np.ascontiguousarray(locmax(sgram).T)
+        pkcols = []
+        pkposs = []
 
-        for col in range(scols):
-            s_col = sgram[:, col]
+        for col in range(len(sgram_t)):
+            s_col = sgram_t[col]
             # Find local magnitude peaks that are above threshold
-            sdmaxposs = np.nonzero(locmax(s_col) * (s_col > sthresh))[0]
-            # Work down list of peaks in order of their absolute value
-            # above threshold
-            valspeaks = sorted(zip(s_col[sdmaxposs], sdmaxposs), reverse=True)
-            for val, peakpos in valspeaks[:self.maxpksperframe]:
-                # What we actually want
-                #sthresh = spreadpeaks([(peakpos, s_col[peakpos])],
-                #                      base=sthresh, width=f_sd)
-                # Optimization - inline the core function within spreadpeaks
-                sthresh = np.maximum(sthresh,
-                                     val*__sp_v[(__sp_pts - peakpos):
-                                                (2*__sp_pts - peakpos)])
-                peaks[peakpos, col] = 1
+            bins = np.flatnonzero(maxmask_t[col] & (s_col > sthresh))
+            if len(bins) == 0:
+                sthresh *= a_dec
+                continue
+            vals = s_col[bins]
+            if len(bins) > self.maxpksperframe:
+                # Keep the peaks with the largest values, breaking ties
+                # towards higher bins as the reverse sort of (value, bin)
+                # pairs would
+                keep = np.lexsort((bins, vals))[-self.maxpksperframe:]
+                bins = bins[keep]
+                vals = vals[keep]
+            bins = bins.tolist()
+            # What we actually want
+            #sthresh = spreadpeaks(zip(bins, vals),
+            #                      base=sthresh, width=f_sd)
+            # Optimization - inline the core function within spreadpeaks,
+            # updating sthresh in place
+            for val, peakpos in zip(vals.tolist(), bins):
+                np.maximum(sthresh,
+                           val*__sp_v[(__sp_pts - peakpos):
+                                      (2*__sp_pts - peakpos)],
+                           out=sthresh)
+            pkcols += [firstcol + col]*len(bins)
+            pkposs += bins
             sthresh *= a_dec
-        return peaks
+        return (np.array(pkcols, dtype=int), np.array(pkposs, dtype=int))
 
     def _decaying_threshold_bwd_prune_peaks(self, sgram, peaks, a_dec):
         """ backwards pass of findpeaks """
         scols = np.shape(sgram)[1]
         # Backwards filter to prune peaks
         sthresh = self.spreadpeaksinvector(sgram[:, -1], self.f_sd)
-        for col in range(scols, 0, -1):
-            pkposs = np.nonzero(peaks[:, col-1])[0]
-            peakvals = sgram[pkposs, col-1]
-            for val, peakpos in sorted(zip(peakvals, pkposs), reverse=True):
-                if val >= sthresh[peakpos]:
-                    # Setup the threshold
-                    sthresh = self.spreadpeaks([(peakpos, val)], base=sthresh,
-                                               width=self.f_sd)
-                    # Delete any following peak (threshold should, but be sure)
-                    if col < scols:
-                        peaks[peakpos, col] = 0
-                else:
-                    # delete the peak
-                    peaks[peakpos, col-1] = 0
-            sthresh = a_dec*sthresh
+        pkcols, pkposs = np.nonzero(peaks.T)
+        delposs, delcols = self._bwd_prune_peak_list(
+            pkcols, pkposs, sgram[pkposs, pkcols], sthresh, scols, a_dec)
+        peaks[delposs, delcols] = 0
         return peaks
 
+    def _bwd_prune_peak_list(self, pkcols, pkposs, peakvals, sthresh, scols,
+                             a_dec):
+        """ Run the backwards pass over peaks given as arrays of their
+            columns, bins and values, in a spectrogram of scols columns,
+            starting from threshold sthresh (which is overwritten).
+            Return the bins and columns of the peaks to delete, as lists.
+        """
+        __sp_pts = len(sthresh)
+        __sp_v = self._gaussian_profile(__sp_pts, self.f_sd)
+        # A column is only changed by the pass once it has been read, so
+        # take the peaks in the order they are visited: columns from last
+        # to first, and within each column the reverse sort of (value, bin)
+        # pairs.
+        order = np.lexsort((pkposs, peakvals, pkcols))[::-1]
+        # Peaks to delete, as (bin, col) pairs
+        delposs = []
+        delcols = []
+        thiscol = scols - 1
+        for col, peakpos, val in zip(pkcols[order].tolist(),
+                                     pkposs[order].tolist(),
+                                     peakvals[order].tolist()):
+            while thiscol > col:
+                sthresh *= a_dec
+                thiscol -= 1
+            if val >= sthresh[peakpos]:
+                # Setup the threshold
+                #sthresh = self.spreadpeaks([(peakpos, val)], base=sthresh,
+                #                           width=self.f_sd)
+                # Optimization - inline the core function within
+                # spreadpeaks, updating sthresh in place
+                np.maximum(sthresh,
+                           val*__sp_v[(__sp_pts - peakpos):
+                                      (2*__sp_pts - peakpos)],
+                           out=sthresh)
+                # Delete any following peak (threshold should, but be sure)
+                if col + 1 < scols:
+                    delposs.append(peakpos)
+                    delcols.append(col + 1)
+            else:
+                # delete the peak
+                delposs.append(peakpos)
+                delcols.append(col)
+        return delposs, delcols
+
     def find_peaks(self, d, sr):
         """ Find the local peaks in the spectrogram as basis for fingerprints.
             Returns a list of (time_frame, freq_bin) pairs.
@@ -270,28 +560,44 @@ class Analyzer(object):
         if len(d) == 0:
             return []
 
-        # masking envelope decay constant
-        a_dec = (1.0 - 0.01*(self.density*np.sqrt(self.n_hop/352.8)/35.0)) \
-                **(1.0/OVERSAMP)
-        # Take spectrogram
-        mywin = np.hanning(self.n_fft+2)[1:-1]
-        sgram = np.abs(librosa.stft(d, n_fft=self.n_fft,
-                                    hop_length=int(self.n_hop),
-                                    window=mywin))
-        sgrammax = np.max(sgram)
-        if sgrammax > 0.0:
-            sgram = np.log(np.maximum(sgram, np.max(sgram)/1e6))
-            sgram -= np.mean(sgram)
-        else:
-            # The sgram is identically zero, i.e., the input signal was identically
-            # zero.  Not good, but let's let it through for now.
-            print("find_peaks: Warning: input signal is identically zero.")
-        # High-pass filter onset emphasis
-        # [:-1,] discards top bin (nyquist) of sgram so bins fit in 8 bits
-        sgram = np.array([scipy.signal.lfilter([1, -1],
-                                               [1, -(HPF_POLE)** \
-                                                (1/OVERSAMP)], s_row)
-                          for s_row in sgram])[:-1,]
+        # Take spectrogram, with high-pass filter onset emphasis
+        return self.sgram2peaks(self._get_spectrogram()(d))
+
+    def find_peaks_shifted(self, d, sr, shifts):
+        """ Return a list of the peaks find_peaks finds in d started
+            shift/shifts of a hop later, for each shift in 0..shifts-1.
+            If shift_threads > 1, the shifts run in up to that many
+            threads, which overlap only in the FFTs and filtering (where
+            numpy and scipy release the GIL). """
+        shifted = [d[int(float(shift)/shifts*self.n_hop):]
+                   for shift in range(shifts)]
+        nthreads = min(shifts, self.shift_threads)
+        if nthreads < 2:
+            return [self.find_peaks(d_shift, sr) for d_shift in shifted]
+        with concurrent.futures.ThreadPoolExecutor(nthreads) as pool:
+            return list(pool.map(lambda d_shift: self.find_peaks(d_shift, sr),
+                                 shifted))
+
+    def _get_spectrogram(self):
+        """ The Spectrogram engine for the current n_fft and n_hop """
+        # Read the attribute once, as another thread may replace it
+        spectrogram = self.spectrogram
+        if (spectrogram is None
+                or spectrogram.n_fft != self.n_fft
+                or spectrogram.n_hop != int(self.n_hop)):
+            spectrogram = Spectrogram(self.n_fft, self.n_hop)
+            self.spectrogram = spectrogram
+        return spectrogram
+
+    def _threshold_decay(self):
+        """ masking envelope decay constant """
+        return (1.0 - 0.01*(self.density*np.sqrt(self.n_hop/352.8)/35.0)) \
+            **(1.0/OVERSAMP)
+
+    def sgram2peaks(self, sgram):
+        """ Find the landmark peaks in a spectrogram made by Spectrogram,
+            as for find_peaks. """
+        a_dec = self._threshold_decay()
         # Prune to keep only local maxima in spectrum that appear above an online,
         # decaying threshold
         peaks = self._decaying_threshold_fwd_prune(sgram, a_dec)
@@ -313,39 +619,65 @@ class Analyzer(object):
             by findpeaks().
             Return a list of (col, peak, peak2, col2-col) landmark descriptors.
         """
-        # Form pairs of peaks into landmarks
-        landmarks = []
-        if len(pklist) > 0:
-            # Find column of the final peak in the list
-            scols = pklist[-1][0] + 1
-            # Convert (col, bin) list into peaks_at[col] lists
-            peaks_at = [[] for col in range(scols)]
-            for (col, bin) in pklist:
-                peaks_at[col].append(bin)
-
-            # Build list of landmarks <starttime F1 endtime F2>
-            for col in range(scols):
-                for peak in peaks_at[col]:
-                    pairsthispeak = 0
-                    for col2 in range(col+self.mindt,
-                                       min(scols, col+self.targetdt)):
-                        if pairsthispeak < self.maxpairsperpeak:
-                            for peak2 in peaks_at[col2]:
-                                if abs(peak2-peak) < self.targetdf:
-                                    #and abs(peak2-peak) + abs(col2-col) > 2 ):
-                                    if pairsthispeak < self.maxpairsperpeak:
-                                        # We have a pair!
-                                        landmarks.append((col, peak,
-                                                          peak2, col2-col))
-                                        pairsthispeak += 1
-
-        return landmarks
-
-    def wavfile2peaks(self, filename, shifts=None):
+        return [tuple(landmark)
+                for landmark in self.peaks2landmarks_array(pklist).tolist()]
+
+    def peaks2landmarks_array(self, peaks):
+        """ Form landmarks from an (N, 2) array (or list) of column-sorted
+            (col, bin) peaks, as an (M, 4) array of (col, peak, peak2,
+            col2-col) rows in the same order as peaks2landmarks.
+            Each peak is paired with up to maxpairsperpeak of the peaks
+            that follow it in the list, from columns mindt to targetdt-1
+            later and less than targetdf bins away.
+        """
+        peaks = np.asarray(peaks, dtype=np.int64).reshape(-1, 2)
+        cols = peaks[:, 0]
+        bins = peaks[:, 1]
+        # Candidates for each peak are the contiguous run of the list
+        # covering the target columns
+        starts = np.searchsorted(cols, cols + self.mindt)
+        ends = np.maximum(starts, np.searchsorted(cols,
+                                                  cols + self.targetdt))
+        # Work along the runs of all the peaks together, one step at a
+        # time, dropping each peak once it has its pairs or runs out
+        npairs = np.zeros(len(peaks), dtype=int)
+        active = np.flatnonzero(ends > starts)
+        pairs1 = []
+        pairs2 = []
+        step = 0
+        while len(active):
+            candidates = starts[active] + step
+            hits = np.abs(bins[candidates] - bins[active]) < self.targetdf
+            pairs1.append(active[hits])
+            pairs2.append(candidates[hits])
+            npairs[active[hits]] += 1
+            step += 1
+            active = active[(npairs[active] < self.maxpairsperpeak)
+                            & (candidates + 1 < ends[active])]
+        if pairs1:
+            pairs1 = np.concatenate(pairs1)
+            pairs2 = np.concatenate(pairs2)
+            # By peak, then in the order their pairs were found
+            order = np.argsort(pairs1, kind='mergesort')
+            pairs1 = pairs1[order]
+            pairs2 = pairs2[order]
+        else:
+            pairs1 = pairs2 = np.zeros(0, dtype=int)
+        return np.c_[cols[pairs1], bins[pairs1], bins[pairs2],
+                     cols[pairs2] - cols[pairs1]]
+
+    def peaks2hashes(self, peaks):
+        """ Form landmarks from column-sorted (col, bin) peaks and return
+            them as an array of (time, hash) pairs.  Equivalent to
+            landmarks2hashes(self.peaks2landmarks(peaks)). """
+        return landmarks2hashes(self.peaks2landmarks_array(peaks))
+
+    def wavfile2peaks(self, filename, shifts=None, return_dur=False):
         """ Read a soundfile and return its landmark peaks as a
             list of (time, bin) pairs.  If specified, resample to sr first.
             shifts > 1 causes hashes to be extracted from multiple shifts of
-            waveform, to reduce frame effects.  """
+            waveform, to reduce frame effects.  return_dur returns
+            (peaks, duration of the soundfile) instead.  """
         ext = os.path.splitext(filename)[1]
         if ext == PRECOMPPKEXT:
             # short-circuit - precomputed fingerprint file
@@ -362,65 +694,90 @@ class Analyzer(object):
                 print(message, "skipping")
                 d = []
                 sr = self.target_sr
-            # Store duration in a global because it's hard to handle
             dur = float(len(d))/sr
             if shifts is None or shifts < 2:
                 peaks = self.find_peaks(d, sr);
             else:
                 # Calculate hashes with optional part-frame shifts
-                peaklists = []
-                for shift in range(shifts):
-                    shiftsamps = int(float(shift)/self.shifts*self.n_hop)
-                    peaklists.append(self.find_peaks(d[shiftsamps:], sr))
-                peaks = peaklists
-
-        # instrumentation to track total amount of sound processed
-        self.soundfiledur = dur
-        self.soundfiletotaldur += dur
-        self.soundfilecount += 1
+                peaks = self.find_peaks_shifted(d, sr, shifts)
+
+        self._record_file(dur)
+        if return_dur:
+            return peaks, dur
         return peaks
 
-    def wavfile2hashes(self, filename):
+    def wavfile2hashes(self, filename, return_dur=False):
         """ Read a soundfile and return its fingerprint hashes as a
             list of (time, hash) pairs.  If specified, resample to sr first.
             shifts > 1 causes hashes to be extracted from multiple shifts of
-            waveform, to reduce frame effects.  """
+            waveform, to reduce frame effects.  return_dur returns
+            (hashes, duration of the soundfile) instead.  """
         ext = os.path.splitext(filename)[1]
+        if self.streaming and ext != PRECOMPEXT and ext != PRECOMPPKEXT:
+            return self.wavfile2hashes_streaming(filename,
+                                                 return_dur=return_dur)
         if ext == PRECOMPEXT:
             # short-circuit - precomputed fingerprint file
             hashes = hashes_load(filename)
             dur = np.max(hashes, axis=0)[0]*self.n_hop/float(self.target_sr)
-            # instrumentation to track total amount of sound processed
-            self.soundfiledur = dur
-            self.soundfiletotaldur += dur
-            self.soundfilecount += 1
+            self._record_file(dur)
         else:
-            peaks = self.wavfile2peaks(filename, self.shifts)
+            peaks, dur = self.wavfile2peaks(filename, self.shifts,
+                                            return_dur=True)
             if len(peaks) == 0:
-              return []
+              hashes = []
+              return (hashes, dur) if return_dur else hashes
             # Did we get returned a list of lists of peaks due to shift?
             if isinstance(peaks[0], list):
                 peaklists = peaks
                 query_hashes = []
                 for peaklist in peaklists:
-                    query_hashes.append(landmarks2hashes(
-                        self.peaks2landmarks(peaklist)))
+                    query_hashes.append(self.peaks2hashes(peaklist))
                 query_hashes = np.concatenate(query_hashes)
             else:
-                query_hashes = landmarks2hashes(self.peaks2landmarks(peaks))
-
-            # Remove duplicates by merging each row into a single value.
-            hashes_hashes = (((query_hashes[:, 0].astype(np.uint64)) << 32)
-                             + query_hashes[:, 1].astype(np.uint64))
-            unique_hash_hash = np.sort(np.unique(hashes_hashes))
-            unique_hashes = np.hstack([
-                (unique_hash_hash >> 32)[:, np.newaxis],
-                (unique_hash_hash & ((1<<32) - 1))[:, np.newaxis]
-            ]).astype(np.int32)
-            hashes = unique_hashes
-            # Or simply np.unique(query_hashes, axis=0) for numpy >= 1.13
+                query_hashes = self.peaks2hashes(peaks)
+
+            hashes = unique_hashes(query_hashes)
 
         #print("wavfile2hashes: read", len(hashes), "hashes from", filename)
+        if return_dur:
+            return hashes, dur
+        return hashes
+
+    def wavfile2hashes_streaming(self, filename,
+                                 chunksecs=STREAM_CHUNK_SECS,
+                                 return_dur=False):
+        """ Return the same hashes as wavfile2hashes, but analyze the
+            soundfile a chunk of about chunksecs at a time, so that long
+            recordings don't have to fit in memory.  The soundfile is
+            decoded once, into a temporary file of samples that the three
+            passes of StreamingAnalyzer then read back. """
+        stream = StreamingAnalyzer(self)
+        chunkbytes = int(chunksecs*self.target_sr)*np.dtype(np.float32).itemsize
+        hashes = None
+        with tempfile.TemporaryFile() as samplefile:
+            try:
+                for samples in audio_read.audio_read_chunks(
+                        filename, sr=self.target_sr, channels=1):
+                    samplefile.write(
+                        samples.astype(np.float32, copy=False).tobytes())
+            except AUDIO_READ_ERRORS:
+                message = "wavfile2hashes_streaming: Error reading " + filename
+                if self.fail_on_error:
+                  raise IOError(message)
+                print(message, "skipping")
+                hashes = []
+            while hashes is None:
+                samplefile.seek(0)
+                data = samplefile.read(chunkbytes)
+                while data:
+                    stream.feed(np.frombuffer(data, dtype=np.float32))
+                    data = samplefile.read(chunkbytes)
+                hashes = stream.finish()
+        dur = float(stream.nsamples)/self.target_sr
+        self._record_file(dur)
+        if return_dur:
+            return hashes, dur
         return hashes
 
     ########### functions to link to actual hash table index database #######
@@ -447,15 +804,186 @@ class Analyzer(object):
         #                                                     density=density,
         #                                                     n_fft=n_fft,
         #                                                     n_hop=n_hop)))
-        hashes = self.wavfile2hashes(filename)
+        hashes, dur = self.wavfile2hashes(filename, return_dur=True)
         hashtable.store(filename, hashes)
         #return (len(d)/float(sr), len(hashes))
         #return (np.max(hashes, axis=0)[0]*n_hop/float(sr), len(hashes))
-        # soundfiledur is set up in wavfile2hashes, use result here
-        return self.soundfiledur, len(hashes)
+        return dur, len(hashes)
+
 
 
 
+class _PeakStream(object):
+    """ The peaks of one shift of the samples fed to a StreamingAnalyzer.
+        Pass 0 finds the largest STFT magnitude, pass 1 the mean of the
+        log magnitudes, and pass 2 runs the forward pass of find_peaks as
+        the spectrogram arrives, keeping its candidate peaks for the
+        backward pass at the end. """
+
+    def __init__(self, analyzer, skip):
+        self.analyzer = analyzer
+        self.spectrogram = analyzer._get_spectrogram()
+        self.skip = skip
+        self.sgrammax = 0.0
+        self.logsum = 0.0
+        self.nvalues = 0
+        self.npass = 0
+        self._start_pass()
+
+    def _start_pass(self):
+        self.stft = _StftStream(self.spectrogram, self.skip)
+        # State of the forward pass
+        self.zi = None
+        self.pending = []
+        self.sthresh = None
+        self.ncols = 0
+        self.lastcol = None
+        self.pkcols = []
+        self.pkposs = []
+        self.pkvals = []
+
+    def feed(self, samples):
+        self._process(self.stft.feed(samples))
+
+    def finish(self):
+        """ End a pass.  Return the peaks, as an (N, 2) array of (col, bin),
+            after the last one, otherwise None. """
+        self._process(self.stft.finish())
+        self.nsamples = self.stft.nsamples
+        peaks = None
+        if self.npass == 0 and self.nsamples and self.sgrammax <= 0.0:
+            # The sgram is identically zero, i.e., the input signal was identically
+            # zero.  Not good, but let's let it through for now.
+            print("find_peaks: Warning: input signal is identically zero.")
+        elif self.npass == 1 and self.nvalues:
+            self.sgrammean = self.spectrogram.dtype.type(
+                self.logsum/self.nvalues)
+        elif self.npass == 2:
+            if self.pending:
+                self._fwd_prune(None)
+            peaks = self._bwd_prune()
+        self.npass += 1
+        self._start_pass()
+        return peaks
+
+    def _process(self, mags):
+        if mags.shape[1] == 0:
+            return
+        if self.npass == 0:
+            self.sgrammax = max(self.sgrammax, np.max(mags))
+        elif self.npass == 1:
+            if self.sgrammax > 0.0:
+                self.spectrogram.log_magnitude(mags, self.sgrammax)
+                self.logsum += np.sum(mags, dtype=np.float64)
+                self.nvalues += mags.size
+        else:
+            # As Spectrogram.enhance, with the whole-recording statistics
+            # and the filter state carried from the previous chunk
+            if self.sgrammax > 0.0:
+                self.spectrogram.log_magnitude(mags, self.sgrammax)
+                mags -= self.sgrammean
+            if self.zi is None:
+                self.zi = np.zeros((mags.shape[0] - 1, 1),
+                                   dtype=self.spectrogram.dtype)
+            sgram, self.zi = scipy.signal.lfilter(
+                self.spectrogram.hpf_b, self.spectrogram.hpf_a, mags[:-1],
+                axis=1, zi=self.zi)
+            self._fwd_prune(sgram)
+
+    def _fwd_prune(self, sgram):
+        """ Continue the forward pass over the next columns of the
+            spectrogram, or the ones held back if sgram is None. """
+        analyzer = self.analyzer
+        if self.sthresh is None:
+            # The initial threshold needs the first 10 frames
+            if sgram is not None:
+                self.pending.append(sgram)
+                if sum(block.shape[1] for block in self.pending) < 10:
+                    return
+            sgram = np.concatenate(self.pending, axis=1)
+            self.pending = []
+            self.sthresh = analyzer.spreadpeaksinvector(
+                np.max(sgram[:, :10], axis=1), analyzer.f_sd)
+        pkcols, pkposs = analyzer._fwd_prune_columns(
+            sgram, self.sthresh, analyzer._threshold_decay(), self.ncols)
+        self.pkcols.append(pkcols)
+        self.pkposs.append(pkposs)
+        self.pkvals.append(sgram[pkposs, pkcols - self.ncols])
+        self.ncols += sgram.shape[1]
+        self.lastcol = sgram[:, -1].copy()
+
+    def _bwd_prune(self):
+        """ Run the backward pass over the candidate peaks and return the
+            ones that survive, in the order of find_peaks. """
+        if self.ncols == 0:
+            return np.zeros((0, 2), dtype=int)
+        analyzer = self.analyzer
+        pkcols = np.concatenate(self.pkcols)
+        pkposs = np.concatenate(self.pkposs)
+        sthresh = analyzer.spreadpeaksinvector(self.lastcol, analyzer.f_sd)
+        delposs, delcols = analyzer._bwd_prune_peak_list(
+            pkcols, pkposs, np.concatenate(self.pkvals), sthresh, self.ncols,
+            analyzer._threshold_decay())
+        # Number each (col, bin) so the deletions can be looked up
+        nbins = len(self.lastcol)
+        keys = pkcols*nbins + pkposs
+        keys = np.sort(keys[~np.isin(keys, np.array(delcols, dtype=int)*nbins
+                                     + np.array(delposs, dtype=int))])
+        return np.c_[keys // nbins, keys % nbins]
+
+
+class StreamingAnalyzer(object):
+    """ Fingerprint a recording fed in as chunks of samples at the
+        analyzer's target_sr, without holding all of it in memory.
+
+        The spectrogram is normalized by its largest value and its mean
+        over the whole recording, and the backward pruning pass of
+        find_peaks works back from the end, so the samples are fed
+        through three times:
+
+            stream = StreamingAnalyzer(analyzer)
+            hashes = None
+            while hashes is None:
+                for samples in chunks_of_the_recording():
+                    stream.feed(samples)
+                hashes = stream.finish()
+
+        The first two passes only gather statistics.  The hashes are the
+        same as analyzer.wavfile2hashes gives for the whole recording.
+        Apart from the chunk being analyzed, the memory used is that of
+        the candidate peaks from the forward pass, a few per frame.
+    """
+
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        shifts = analyzer.shifts
+        if shifts is None or shifts < 2:
+            shifts = 1
+        self.shifts = shifts
+        self.streams = [
+            _PeakStream(analyzer,
+                        int(float(shift)/shifts*analyzer.n_hop))
+            for shift in range(shifts)]
+        # Number of samples fed in the last pass
+        self.nsamples = 0
+
+    def feed(self, samples):
+        """ Add the next chunk of samples """
+        for stream in self.streams:
+            stream.feed(samples)
+
+    def finish(self):
+        """ End a pass through the samples.  After the last pass, return
+            the hashes, otherwise None. """
+        peaklists = [stream.finish() for stream in self.streams]
+        self.nsamples = self.streams[0].nsamples
+        if peaklists[0] is None:
+            return None
+        if self.shifts == 1 and len(peaklists[0]) == 0:
+            return []
+        return unique_hashes(np.concatenate(
+            [self.analyzer.peaks2hashes(peaks) for peaks in peaklists]))
+
 
 ########### functions to read/write hashes to file for a single track #####
 
@@ -26,6 +26,7 @@ class MatchResult(object):
     def __init__(self):
         self.message_list = list()
         self.match_file_names = list()
+        self.match_ids = list()
 
 
 def log(message):
@@ -197,7 +198,8 @@ class Matcher(object):
         #allotimes = sorted_hits[:, 3]
         # Allocate enough space initially for 4 modes per hit
         maxnresults = len(ids) * 4
-        results = np.zeros((maxnresults, 7), np.int32)
+        # Same (narrowest) dtype as the hits
+        results = np.zeros((maxnresults, 7), hits.dtype)
         nresults = 0
         min_time = 0
         max_time = 0
@@ -247,7 +249,8 @@ class Matcher(object):
         # there are more than threshcount matches at the single best time skew.
         # Note: now we allow multiple matches per ID, this may need to grow
         # so it can grow inside the loop.
-        results = np.zeros((len(ids), 7), np.int32)
+        # Same (narrowest) dtype as the hits
+        results = np.zeros((len(ids), 7), hits.dtype)
         if not hits.size:
             # No hits found, return empty results
             return results
@@ -286,7 +289,7 @@ class Matcher(object):
                 nresults += 1
                 if nresults >= results.shape[0]:
                     results = np.vstack([results, np.zeros(results.shape,
-                                                           np.int32)])
+                                                           results.dtype)])
                 # Clear this hit to find next largest.
                 filtered_bincounts[max(0, mode - self.window):
                                    (mode + self.window + 1)] = 0
@@ -400,6 +403,7 @@ class Matcher(object):
                 else:
                     match_result.message_list.append(qrymsg + "\t" + ht.names[tophitid])
                 match_result.match_file_names.append(ht.names[tophitid])
+                match_result.match_ids.append(tophitid)
                 if self.illustrate:
                     self.illustrate_match(analyzer, ht, qry)
         return match_result
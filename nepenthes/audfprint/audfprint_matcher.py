@@ -228,34 +228,49 @@ class AudioPrintMatcher(object):
         # args = docopt.docopt(USAGE, version=__version__, argv=values)
         analyzer = setup_analyzer(args)
         precomp_type = 'hashes'
+        self.args = args
+        self.analyzer = analyzer
 
         # For everything other than precompute, we need a database name
         # Check we have one
         dbasename = args['--dbase']
         # Load existing hash table file (add, match, merge)
-        hash_tab = hash_table.HashTable(dbasename)
-        if analyzer and 'samplerate' in hash_tab.params \
-            and hash_tab.params['samplerate'] != analyzer.target_sr:
-            # analyzer.target_sr = hash_tab.params['samplerate']
-            print("db samplerate overridden to ", analyzer.target_sr)
+        hash_tab = self.load_hash_table(dbasename)
 
         # Create a matcher
         matcher = setup_matcher(args)
 
-        self.args = args
-        self.analyzer = analyzer
         self.matcher = matcher
         self.hash_table = hash_tab
         self.precomp_type = precomp_type
 
-    def execute2(self, file_names: list, report):
+    @property
+    def dbasename(self):
+        return self.args['--dbase']
+
+    def load_hash_table(self, dbasename):
+        """ Read a hash table to match against; it can be passed to execute
+            in place of the one read at startup. """
+        # Matching only reads the table, so keep just the occupied entries
+        hash_tab = hash_table.HashTable(dbasename, frozen=True)
+        if self.analyzer and 'samplerate' in hash_tab.params \
+            and hash_tab.params['samplerate'] != self.analyzer.target_sr:
+            # analyzer.target_sr = hash_tab.params['samplerate']
+            print("db samplerate overridden to ", self.analyzer.target_sr)
+        return hash_tab
+
+    def execute2(self, file_names: list, report, hash_tab=None):
         # python3 audfprint.py match --dbase fpdbase.pklz sound/matsumushi.mp3
-        do_cmd_multiproc("match", self.analyzer, self.hash_table, file_names,
+        if hash_tab is None:
+            hash_tab = self.hash_table
+        do_cmd_multiproc("match", self.analyzer, hash_tab, file_names,
                          self.matcher, self.args['--precompdir'],
                          self.precomp_type,
                          report,
                          ncores=1)
 
-    def execute(self, file_names: list, report):
-        do_cmd("match", self.analyzer, self.hash_table, file_names,
+    def execute(self, file_names: list, report, hash_tab=None):
+        if hash_tab is None:
+            hash_tab = self.hash_table
+        do_cmd("match", self.analyzer, hash_tab, file_names,
                self.matcher, self.args['--precompdir'], self.precomp_type, report)
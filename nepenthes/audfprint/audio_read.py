@@ -70,6 +70,15 @@ def audio_read(filename, sr=None, channels=None):
     return (y, sr)
 
 
+def audio_read_chunks(filename, sr=None, channels=None):
+    """Read a soundfile as a series of float32 sample arrays, without
+    holding the whole file in memory.  Channels are interleaved."""
+    with FFmpegAudioFile(os.path.realpath(filename),
+                         sample_rate=sr, channels=channels) as input_file:
+        for frame in input_file:
+            yield buf_to_float(frame, dtype=np.float32)
+
+
 def buf_to_float(x, n_bytes=2, dtype=np.float32):
     """Convert an integer buffer to floating point values.
     This is primarily useful when loading integer-valued wav data
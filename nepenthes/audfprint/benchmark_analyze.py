@@ -0,0 +1,88 @@
+# benchmark_analyze.py
+#
+# Time the spectrogram front-end and the rest of the fingerprint analysis
+# on synthetic audio, reported as cost per second of audio.
+# Run from the nepenthes directory:
+# > python -m audfprint.benchmark_analyze [seconds] [density]
+
+import sys
+import time
+
+import numpy as np
+import scipy.signal
+
+from audfprint import audfprint_analyze
+
+seconds = 180
+density = 70
+if len(sys.argv) > 1:
+    seconds = int(sys.argv[1])
+if len(sys.argv) > 2:
+    density = float(sys.argv[2])
+
+sr = 11025
+nrepeats = 3
+
+# Decaying tones over noise, so there are plenty of peaks to find
+rng = np.random.RandomState(0)
+t = np.arange(seconds * sr) / float(sr)
+d = 0.1 * rng.randn(len(t))
+for ix in range(seconds):
+    freq = rng.uniform(100, 5000)
+    onset = rng.uniform(0, seconds)
+    d += np.sin(2 * np.pi * freq * t) * np.exp(-((t - onset) / 0.5) ** 2)
+d = d.astype(np.float32)
+
+
+def report(name, elapsed):
+    print("{}: {:.3f} s for {} s of audio = {:.2f} ms per second".format(
+        name, elapsed, seconds, 1000.0 * elapsed / seconds))
+
+
+def best_time(fn):
+    elapsed = []
+    for ix in range(nrepeats):
+        initticks = time.time()
+        fn()
+        elapsed.append(time.time() - initticks)
+    return min(elapsed)
+
+
+def reference_spectrogram():
+    """ The spectrogram as find_peaks used to compute it """
+    import librosa
+    mywin = np.hanning(audfprint_analyze.N_FFT+2)[1:-1]
+    sgram = np.abs(librosa.stft(d, n_fft=audfprint_analyze.N_FFT,
+                                hop_length=audfprint_analyze.N_HOP,
+                                window=mywin))
+    sgram = np.log(np.maximum(sgram, np.max(sgram)/1e6))
+    sgram -= np.mean(sgram)
+    return np.array([scipy.signal.lfilter([1, -1],
+                                          [1, -audfprint_analyze.HPF_POLE],
+                                          s_row)
+                     for s_row in sgram])[:-1,]
+
+
+try:
+    report("reference spectrogram (librosa.stft)",
+           best_time(reference_spectrogram))
+except ImportError:
+    print("librosa not available, skipping reference spectrogram")
+
+spectrogram = audfprint_analyze.Spectrogram()
+report("Spectrogram", best_time(lambda: spectrogram(d)))
+
+analyzer = audfprint_analyze.Analyzer(density)
+peaks = analyzer.find_peaks(d, sr)
+report("find_peaks", best_time(lambda: analyzer.find_peaks(d, sr)))
+hashes = analyzer.peaks2hashes(peaks)
+report("peaks2hashes", best_time(lambda: analyzer.peaks2hashes(peaks)))
+print("{} peaks, {} hashes".format(len(peaks), len(hashes)))
+
+# Sub-frame shifts, as for match (default 4 shifts), in turn and in threads
+shifts = 4
+for nthreads in [1, shifts]:
+    analyzer.shift_threads = nthreads
+    report("find_peaks_shifted, {} shifts, {} threads".format(shifts,
+                                                              nthreads),
+           best_time(lambda: analyzer.find_peaks_shifted(d, sr, shifts)))
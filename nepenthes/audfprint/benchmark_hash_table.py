@@ -0,0 +1,62 @@
+# benchmark_hash_table.py
+#
+# Time the core HashTable operations on synthetic fingerprints, sized like
+# a MIREX-style build (density 70, fanout 8, bucketsize 500).
+# Run from the nepenthes directory:
+# > python -m audfprint.benchmark_hash_table [hashbits] [depth] [nfiles]
+
+import sys
+import time
+
+import numpy as np
+
+from audfprint import hash_table
+
+hashbits = 20
+depth = 500
+nfiles = 20
+if len(sys.argv) > 1:
+    hashbits = int(sys.argv[1])
+if len(sys.argv) > 2:
+    depth = int(sys.argv[2])
+if len(sys.argv) > 3:
+    nfiles = int(sys.argv[3])
+
+# About 3 minutes of audio per file at ~560 hashes/sec
+hashes_per_file = 100000
+maxtime = 16384
+
+rng = np.random.RandomState(0)
+filehashes = []
+for ix in range(nfiles):
+    times = np.sort(rng.randint(0, maxtime, hashes_per_file))
+    hashes = rng.randint(0, 1 << hashbits, hashes_per_file)
+    filehashes.append(np.c_[times, hashes].astype(np.int32))
+
+ht = hash_table.HashTable(hashbits=hashbits, depth=depth, maxtime=maxtime)
+initticks = time.time()
+for ix, hashes in enumerate(filehashes):
+    ht.store("file%d" % ix, hashes)
+elapsed = time.time() - initticks
+print("store: {} hashes in {:.3f} s = {:.0f} hashes/sec".format(
+    nfiles * hashes_per_file, elapsed, nfiles * hashes_per_file / elapsed))
+
+# A 14 second query at density 70 / fanout 8 gives ~8000 hashes
+nqueries = 20
+query_hashes = np.c_[rng.randint(0, 600, 8000),
+                     rng.randint(0, 1 << hashbits, 8000)].astype(np.int32)
+initticks = time.time()
+for ix in range(nqueries):
+    hits = ht.get_hits(query_hashes)
+elapsed = time.time() - initticks
+print("get_hits: {} queries in {:.3f} s = {:.1f} ms/query ({} hits)".format(
+    nqueries, elapsed, 1000.0 * elapsed / nqueries, len(hits)))
+
+# Merge a second table built from the same files, as multiproc_add does
+ht2 = hash_table.HashTable(hashbits=hashbits, depth=depth, maxtime=maxtime)
+for ix, hashes in enumerate(filehashes):
+    ht2.store("other%d" % ix, hashes)
+initticks = time.time()
+ht.merge(ht2)
+elapsed = time.time() - initticks
+print("merge: {} hashes in {:.3f} s".format(np.sum(ht2.counts), elapsed))
@@ -9,12 +9,20 @@ used for the audfprint fingerprinter.
 from __future__ import print_function
 
 import numpy as np
-import random
 # import _pickle as pickle
 import pickle
 import os, gzip
 import scipy.io
+# For choose_size
+import scipy.stats
 import math
+import struct
+import heapq
+import itertools
+import zlib
+import lzma
+# For merge_tables
+import concurrent.futures
 
 # Current format version
 HT_VERSION = 20170724
@@ -23,6 +31,42 @@ HT_COMPAT_VERSION = 20170724
 # Earliest version that can be updated with load_old
 HT_OLD_COMPAT_VERSION = 20140920
 
+# Magic string at the start of the uncompressed, memory-mappable format
+HT_MMAP_MAGIC = b'audfprintHTmmap0'  # 16 chars, like the hash files
+# Saving to a file with this extension selects the memory-mappable format
+HT_MMAP_EXT = '.fpmm'
+# Arrays in the memory-mappable format start on page boundaries
+HT_MMAP_ALIGN = 4096
+
+# Magic string at the start of the chunked, compressed format
+HT_CHUNKED_MAGIC = b'audfprintHTchnk0'
+# Saving to a file with this extension selects the chunked format
+HT_CHUNKED_EXT = '.fpcz'
+# Arrays in the chunked format are split into blocks of about this size
+HT_CHUNK_BYTES = 1 << 22
+# Saving to a file with this extension writes the chunked format with
+# only the occupied buckets
+HT_SPARSE_EXT = '.fpsz'
+# Compressors available for the chunked format
+HT_CHUNK_CODECS = {'zlib': (zlib.compress, zlib.decompress),
+                   'lzma': (lzma.compress, lzma.decompress)}
+
+# Magic string at the start of the (uncompressed) contents of a pklz file
+# with a metadata header ahead of the pickled table
+HT_PKL_MAGIC = b'audfprintHTpklz0'
+
+# Arrays (and the layout flag) that open_metadata defers loading
+HT_LAZY_ATTRS = ('table', 'counts', 'offsets', 'values', 'id_buckets',
+                 'frozen')
+
+# Dtypes for table entries packing (id + 1, time), by entrybits
+HT_ENTRY_DTYPES = {32: np.uint32, 64: np.uint64}
+
+# Appended to the dbase name to give the name of its journal of updates
+HT_JOURNAL_EXT = '.journal'
+# First record in a journal file
+HT_JOURNAL_MAGIC = 'audfprintjournalV00'
+
 def _bitsfor(maxval):
     """ Convert a maxval into a number of bits (left shift).
         Raises a ValueError if the maxval is not a power of 2. """
@@ -31,6 +75,191 @@ def _bitsfor(maxval):
         raise ValueError("maxval must be a power of 2, not %d" % maxval)
     return maxvalbits
 
+def _align(offset, alignment=HT_MMAP_ALIGN):
+    """ Round offset up to the next multiple of alignment. """
+    return -(-offset // alignment) * alignment
+
+def _map_array(name, offset, dtype, shape):
+    """ Map one array stored at offset in file <name>, copy-on-write.
+        The file itself is only ever opened read-only. """
+    if int(np.prod(shape)) == 0:
+        # np.memmap refuses to map zero bytes
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(name, dtype=np.dtype(dtype), mode='c', offset=offset,
+                     shape=tuple(shape))
+
+
+def _read_mmap_header(f, name):
+    """ Return the header of an open memory-mappable hash table file. """
+    magic = f.read(len(HT_MMAP_MAGIC))
+    if magic != HT_MMAP_MAGIC:
+        raise IOError('%s is not a mmap hash table (magic %s)'
+                      % (name, magic))
+    headerlen = struct.unpack('<Q', f.read(8))[0]
+    return pickle.loads(f.read(headerlen))
+
+def _read_metadata(name):
+    """ Return the header of a saved hash table, including hashesperid,
+        without reading the table itself, or None if the file has no
+        separate header (a mat file, or a pklz from before HT_PKL_MAGIC). """
+    if os.path.splitext(name)[1] == '.mat':
+        return None
+    with open(name, 'rb') as f:
+        magic = f.read(len(HT_MMAP_MAGIC))
+        f.seek(0)
+        if magic == HT_MMAP_MAGIC:
+            header = _read_mmap_header(f, name)
+            header['hashesperid'] = _map_array(
+                name, *header['arrays']['hashesperid'])
+            return header
+        if magic == HT_CHUNKED_MAGIC:
+            header = _read_chunked_header(f, name)
+            with concurrent.futures.ThreadPoolExecutor(1) as pool:
+                header['hashesperid'] = _read_chunked_array(
+                    f, header['arrays']['hashesperid'], header['codec'], pool)
+            return header
+    with gzip.open(name, 'rb') as f:
+        if f.read(len(HT_PKL_MAGIC)) != HT_PKL_MAGIC:
+            return None
+        return pickle.load(f)
+
+def _read_chunk(f, chunk, codec):
+    """ Read and decompress one block of a chunked hash table file.
+        os.pread lets threads share the file without seeking. """
+    _, _, offset, nbytes = chunk
+    return HT_CHUNK_CODECS[codec][1](os.pread(f.fileno(), nbytes, offset))
+
+def _read_chunked_header(f, name):
+    """ Return the header of an open chunked hash table file. """
+    magic = f.read(len(HT_CHUNKED_MAGIC))
+    if magic != HT_CHUNKED_MAGIC:
+        raise IOError('%s is not a chunked hash table (magic %s)'
+                      % (name, magic))
+    headeroffset = struct.unpack('<Q', f.read(8))[0]
+    f.seek(headeroffset)
+    return pickle.loads(f.read())
+
+def _read_chunked_array(f, spec, codec, pool, start=None, end=None):
+    """ Decompress the blocks of one array in a chunked file in parallel.
+        If start and end are given, only blocks overlapping those rows
+        are read, and only rows start:end are filled in; the other rows
+        are left as zeros (which np.zeros does not actually commit to
+        memory until they are written).
+    """
+    dtype, shape, chunks = spec
+    array = np.zeros(shape, dtype=np.dtype(dtype))
+    if start is None:
+        start, end = 0, shape[0]
+    chunks = [chunk for chunk in chunks
+              if chunk[0] < end and chunk[1] > start]
+    def read_into(chunk):
+        rows = np.frombuffer(
+            _read_chunk(f, chunk, codec), dtype=array.dtype).reshape(
+                (chunk[1] - chunk[0],) + tuple(shape[1:]))
+        # Blocks at the ends of the range also hold rows outside it
+        first, last = max(chunk[0], start), min(chunk[1], end)
+        array[first:last] = rows[first - chunk[0]:last - chunk[0]]
+    list(pool.map(read_into, chunks))
+    return array
+
+def read_chunked_rows(name, key, start, end, nthreads=None):
+    """ Read just rows start:end of one array (e.g. 'table' or 'counts')
+        from a chunked hash table file, decompressing only the blocks that
+        hold them. """
+    with open(name, 'rb') as f:
+        header = _read_chunked_header(f, name)
+        with concurrent.futures.ThreadPoolExecutor(nthreads) as pool:
+            array = _read_chunked_array(f, header['arrays'][key],
+                                        header['codec'], pool, start, end)
+    return array[start:end]
+
+def _merge_pair(pair):
+    """ Merge the second of a pair of hash tables into the first. """
+    pair[0].merge(pair[1])
+    return pair[0]
+
+def merge_tables(tables, nthreads=None, maxtables=None):
+    """ Merge a list (or iterator) of hash tables into the first one.  The
+        merges run as a tree of pairwise merges, with the merges at each
+        level running in parallel threads (numpy releases the GIL for the
+        sorting and copying that dominate merge).  The ids come out in the
+        same order as merging the tables one after another.  An
+        intermediate merge keeps the depth and entry size of its left-hand
+        table, so tables that differ from the first in either are merged
+        into it one after another instead.  If maxtables is given, the rest
+        of the tables are taken from the iterator in batches of at most
+        maxtables, each merged into the first before the next is taken, so
+        at most maxtables + 1 tables are held at once.
+    """
+    tables = iter(tables)
+    first = next(tables)
+    with concurrent.futures.ThreadPoolExecutor(nthreads) as pool:
+        while True:
+            batch = [first] + list(itertools.islice(tables, maxtables))
+            if len(batch) == 1:
+                break
+            if any(ht.depth != first.depth or ht.entrybits != first.entrybits
+                   for ht in batch):
+                for ht in batch[1:]:
+                    first.merge(ht)
+                continue
+            while len(batch) > 1:
+                merged = list(pool.map(_merge_pair,
+                                       zip(batch[0::2], batch[1::2])))
+                if len(batch) % 2:
+                    merged.append(batch[-1])
+                batch = merged
+    return first
+
+def _dropped_by_depth(nhashes, hashbits, maxdepth):
+    """ Expected fraction of nhashes hashes dropped by 2^hashbits buckets
+        of each depth from 1 to maxdepth, if the hashes land uniformly at
+        random so that each bucket gets a Poisson number of them.  Real
+        hashes are less even, so treat these as lower bounds. """
+    lam = nhashes / float(1 << hashbits)
+    if lam == 0:
+        return np.zeros(maxdepth)
+    # E[min(X, depth)] is the sum of P(X > k) for k < depth
+    kept = np.cumsum(scipy.stats.poisson.sf(np.arange(maxdepth), lam))
+    return np.maximum(0.0, 1.0 - kept / lam)
+
+def choose_size(nhashes, max_dropped=0.01, max_bytes=None, max_hashbits=20,
+                entrybits=32):
+    """ Pick (hashbits, depth) for a table to hold about nhashes hashes.
+        Fewer hashbits mean distinct hashes share buckets, and so more
+        false hits per query hash; hashes from the analyzer have 20 bits,
+        so more than that would be wasted.  So take the most hashbits for
+        which some depth is expected to drop at most max_dropped of the
+        hashes (see _dropped_by_depth) within max_bytes, and the shallowest
+        such depth.  If nothing meets both budgets, take the most hashbits
+        that use all of max_bytes to drop within max_dropped of the fewest
+        hashes any table that size could.  entrybits is the size of each
+        entry, as for HashTable.
+        Returns (hashbits, depth, expected dropped fraction).
+    """
+    candidates = []
+    for hashbits in range(max_hashbits, 0, -1):
+        nbuckets = 1 << hashbits
+        lam = nhashes / float(nbuckets)
+        # Deep enough that hardly any bucket overflows
+        maxdepth = int(lam + 10 * math.sqrt(lam) + 10)
+        if max_bytes is not None:
+            # Each bucket is depth entries plus an int32 count
+            maxdepth = min(maxdepth, int((max_bytes // nbuckets - 4)
+                                         // (entrybits // 8)))
+        if maxdepth < 1:
+            continue
+        dropped = _dropped_by_depth(nhashes, hashbits, maxdepth)
+        fits = np.flatnonzero(dropped <= max_dropped)
+        if len(fits):
+            return hashbits, int(fits[0]) + 1, float(dropped[fits[0]])
+        candidates.append((hashbits, maxdepth, float(dropped[-1])))
+    if not candidates:
+        raise ValueError("no table fits in %d bytes" % max_bytes)
+    fewest = min(candidate[2] for candidate in candidates)
+    for candidate in candidates:
+        if candidate[2] <= fewest + max_dropped:
+            return candidate
 
 class HashTable(object):
     """
@@ -42,166 +271,657 @@ class HashTable(object):
        >>> list_of_ids_tracks = ht.get_hits(hash)
     """
 
-    def __init__(self, filename=None, hashbits=20, depth=100, maxtime=16384):
-        """ allocate an empty hash table of the specified size """
-        if filename is not None:
-            self.load(filename)
+    def __init__(self, filename=None, hashbits=20, depth=100, maxtime=16384,
+                 frozen=None, lazy=False, entrybits=32):
+        """ allocate an empty hash table of the specified size,
+            or read one from filename (see load() for frozen, and
+            open_metadata() for lazy).  Each entry packs an id and a time
+            into entrybits (32 or 64) bits, so there is room for
+            2^(entrybits - maxtimebits) - 1 ids; 64-bit entries allow for
+            long reference recordings (large maxtime) at twice the
+            memory. """
+        # Not recording updates to a journal (see open_journal())
+        self.journal_file = None
+        # No journal replayed by load()
+        self.journal_end = None
+        # Not waiting to load a table (see open_metadata())
+        self.lazy_name = None
+        if filename is not None and lazy:
+            self.open_metadata(filename)
+        elif filename is not None:
+            self.load(filename, frozen=frozen)
         else:
             self.hashbits = hashbits
             self.depth = depth
             self.maxtimebits = _bitsfor(maxtime)
+            if entrybits not in HT_ENTRY_DTYPES:
+                raise ValueError("entrybits must be one of "
+                                 + str(sorted(HT_ENTRY_DTYPES)))
+            if self.maxtimebits >= entrybits:
+                raise ValueError("maxtime %d leaves no room for ids in "
+                                 "%d-bit entries" % (maxtime, entrybits))
             # allocate the big table
             size = 2**hashbits
-            self.table = np.zeros((size, depth), dtype=np.uint32)
+            self.table = np.zeros((size, depth),
+                                  dtype=HT_ENTRY_DTYPES[entrybits])
             # keep track of number of entries in each list
             self.counts = np.zeros(size, dtype=np.int32)
             # map names to IDs
             self.names = []
+            # display label (e.g. catalog object name) for each id
+            self.labels = []
             # track number of hashes stored per id
             self.hashesperid = np.zeros(0, np.uint32)
             # Empty params
             self.params = {}
             # Record the current version
             self.ht_version = HT_VERSION
+            # Not in the compact read-only layout (see freeze())
+            self.frozen = False
+            # No per-id index of buckets until build_index() is called
+            self.id_buckets = None
+            # get_hits uses every bucket (see set_stop_count())
+            self.stop_count = None
+            # name -> id dict and free id heap
+            self._index_names()
             # Mark as unsaved
             self.dirty = True
 
+    def __getattr__(self, attr):
+        """ Load the table of a hash table opened by open_metadata the
+            first time one of its arrays is used. """
+        if self.__dict__.get('lazy_name') is None or attr not in HT_LAZY_ATTRS:
+            raise AttributeError(attr)
+        self._load_lazy()
+        return getattr(self, attr)
+
+    def __getstate__(self):
+        """ Pickle everything except an open journal file. """
+        if self.lazy_name is not None:
+            self._load_lazy()
+        state = self.__dict__.copy()
+        state['journal_file'] = None
+        state['journal_end'] = None
+        return state
+
     def reset(self):
         """ Reset to empty state (but preserve parameters) """
+        if self.frozen:
+            self.thaw()
         self.table[:,:] = 0
         self.counts[:] = 0
         self.names = []
+        self.labels = []
         self.hashesperid.resize(0)
+        if self.id_buckets is not None:
+            self.id_buckets = []
+        self._index_names()
         self.dirty = True
 
     def store(self, name, timehashpairs):
         """ Store a list of hashes in the hash table
             associated with a particular name (or integer ID) and time.
+            The whole batch is inserted with grouped numpy operations;
+            buckets that overflow are filled by reservoir sampling, exactly
+            as if the pairs had been stored one at a time.
         """
+        if self.frozen:
+            self.thaw()
         id_ = self.name_to_id(name, add_if_missing=True)
+        self._check_ids(id_ + 1)
         # Now insert the hashes
         hashmask = (1 << self.hashbits) - 1
-        #mxtime = self.maxtime
         maxtime = 1 << self.maxtimebits
         timemask = maxtime - 1
-        # Try sorting the pairs by hash value, for better locality in storing
-        #sortedpairs = sorted(timehashpairs, key=lambda x:x[1])
-        sortedpairs = timehashpairs
-        # Tried making it an np array to permit vectorization, but slower...
-        #sortedpairs = np.array(sorted(timehashpairs, key=lambda x:x[1]),
-        #                       dtype=int)
-        # Keep only the bottom part of the time value
-        #sortedpairs[:,0] = sortedpairs[:,0] % self.maxtime
-        # Keep only the bottom part of the hash value
-        #sortedpairs[:,1] = sortedpairs[:,1] & hashmask
-        # The id value is based on (id_ + 1) to avoid an all-zero value.
-        idval = (id_ + 1) << self.maxtimebits
-        for time_, hash_ in sortedpairs:
-            # Keep only the bottom part of the hash value
-            hash_ &= hashmask
-            # How many already stored for this hash?
-            count = self.counts[hash_]
-            # Keep only the bottom part of the time value
-            #time_ %= mxtime
-            time_ &= timemask
-            # Mixin with ID
-            val = (idval + time_) #.astype(np.uint32)
-            if count < self.depth:
-                # insert new val in next empty slot
-                #slot = self.counts[hash_]
-                self.table[hash_, count] = val
-            else:
-                # Choose a point at random
-                slot = random.randint(0, count)
-                # Only store if random slot wasn't beyond end
-                if slot < self.depth:
-                    self.table[hash_, slot] = val
-            # Update record of number of vals in this bucket
-            self.counts[hash_] = count + 1
+        pairs = np.asarray(timehashpairs, dtype=np.int64).reshape(-1, 2)
+        if len(pairs) > 0:
+            # The id value is based on (id_ + 1) to avoid an all-zero value.
+            idval = (id_ + 1) << self.maxtimebits
+            # Keep only the bottom part of the hash and time values
+            hashes = pairs[:, 1] & hashmask
+            entrytype = self.table.dtype.type
+            vals = ((pairs[:, 0] & timemask).astype(entrytype)
+                    | entrytype(idval))
+            # Sort by hash value (stably, so each bucket still sees its
+            # entries in arrival order) to group entries for each bucket.
+            order = np.argsort(hashes, kind='mergesort')
+            hashes = hashes[order]
+            vals = vals[order]
+            runstarts = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]])
+            runlens = np.diff(np.r_[runstarts, len(hashes)])
+            # How many vals the bucket had already seen as each one arrives
+            seen = (self.counts[hashes].astype(np.int64)
+                    + np.arange(len(hashes)) - np.repeat(runstarts, runlens))
+            slots = seen.copy()
+            full = seen >= self.depth
+            if np.any(full):
+                # Choose a point at random in 0..seen (inclusive), and
+                # only store if random slot wasn't beyond end.  (randint
+                # only takes an array high from numpy 1.17.)
+                slots[full] = (np.random.random_sample(np.sum(full))
+                               * (seen[full] + 1)).astype(np.int64)
+            keep = np.flatnonzero(slots < self.depth)
+            # Where several vals land in the same slot, the last to
+            # arrive wins.  Find the last occurrence of each (hash, slot).
+            flatslots = hashes[keep] * self.depth + slots[keep]
+            _, lastix = np.unique(flatslots[::-1], return_index=True)
+            keep = keep[len(keep) - 1 - lastix]
+            self.table[hashes[keep], slots[keep]] = vals[keep]
+            # Update record of number of vals in each bucket
+            self.counts[hashes[runstarts]] += runlens.astype(np.int32)
+            if self.id_buckets is not None:
+                self.id_buckets[id_] = np.union1d(
+                    self.id_buckets[id_], hashes[runstarts]).astype(np.uint32)
+        if self.journal_file:
+            self._journal(('store', self.names[id_], pairs.astype(np.int32)))
         # Record how many hashes we (attempted to) save for this id
-        self.hashesperid[id_] += len(timehashpairs)
+        self.hashesperid[id_] += len(pairs)
         # Mark as unsaved
         self.dirty = True
 
+    @property
+    def entrybits(self):
+        """ Bits in each table entry (see __init__). """
+        entries = self.values if self.frozen else self.table
+        return 8 * entries.dtype.itemsize
+
+    def _check_ids(self, nids):
+        """ Raise ValueError unless ids up to nids - 1 fit in the entries. """
+        if nids >= 1 << (self.entrybits - self.maxtimebits):
+            raise ValueError("%d ids do not fit in %d-bit entries with "
+                             "maxtimebits %d" % (nids, self.entrybits,
+                                                 self.maxtimebits))
+
+    def _hit_dtype(self):
+        """ Narrowest dtype for reporting the ids and times in entries. """
+        if len(self.names) < (1 << 31) and self.maxtimebits < 31:
+            return np.int32
+        return np.int64
+
     def get_entry(self, hash_):
         """ Return np.array of [id, time] entries
             associate with the given hash as rows.
         """
-        vals = self.table[hash_, :min(self.depth, self.counts[hash_])]
-        maxtimemask = (1 << self.matimebits) - 1
+        _, vals = self._bucket_entries(np.array([hash_]))
+        maxtimemask = (1 << self.maxtimebits) - 1
         # ids we report externally start at 0, but in table they start at 1.
-        ids = (vals >> self.maxtimebits) - 1
-        return np.c_[ids, vals & maxtimemask].astype(np.int32)
+        ids = (vals >> self.maxtimebits).astype(np.int64) - 1
+        return np.c_[ids, vals & maxtimemask].astype(self._hit_dtype())
 
     def get_hits(self, hashes):
         """ Return np.array of [id, delta_time, hash, time] rows
             associated with each element in hashes array of [time, hash] rows.
-            This version has get_entry() inlined, it's about 30% faster.
+            The output is sized exactly from the bucket counts and filled
+            with fancy indexing, with no per-hash Python loop.
         """
-        # Allocate to largest possible number of hits
-        nhashes = np.shape(hashes)[0]
-        hits = np.zeros((nhashes*self.depth, 4), np.int32)
-        nhits = 0
+        hashes = np.asarray(hashes, dtype=np.int64).reshape(-1, 2)
         maxtimemask = (1 << self.maxtimebits) - 1
         hashmask = (1 << self.hashbits) - 1
-        # Fill in
-        for ix in range(nhashes):
-            time_ = hashes[ix][0]
-            hash_ = hashmask & hashes[ix][1]
-            nids = min(self.depth, self.counts[hash_])
-            tabvals = self.table[hash_, :nids]
-            hitrows = nhits + np.arange(nids)
-            # Make external IDs start from 0.
-            hits[hitrows, 0] = (tabvals >> self.maxtimebits) - 1
-            hits[hitrows, 1] = (tabvals & maxtimemask) - time_
-            hits[hitrows, 2] = hash_
-            hits[hitrows, 3] = time_
-            nhits += nids
-        # Discard the excess rows
-        hits.resize( (nhits, 4) )
+        times = hashes[:, 0].astype(self._hit_dtype())
+        hashvals = (hashes[:, 1] & hashmask).astype(np.int32)
+        if self.stop_count is not None:
+            # Skip the stop hashes
+            keep = self.counts[hashvals] <= self.stop_count
+            times = times[keep]
+            hashvals = hashvals[keep]
+        hashix, tabvals = self._bucket_entries(hashvals)
+        # 64-bit entries still give 32-bit hits, unless the ids or times
+        # need more.
+        hitdtype = self._hit_dtype()
+        hits = np.empty((len(tabvals), 4), hitdtype)
+        # Make external IDs start from 0.
+        hits[:, 0] = (tabvals >> self.maxtimebits).astype(hitdtype) - 1
+        hits[:, 1] = (tabvals & maxtimemask).astype(hitdtype) - times[hashix]
+        hits[:, 2] = hashvals[hashix]
+        hits[:, 3] = times[hashix]
         return hits
 
+    def _bucket_entries(self, buckets):
+        """ Return (rowix, vals) for every stored entry in the listed
+            buckets, where vals[i] was read from bucket buckets[rowix[i]].
+            Entries come out bucket by bucket, in slot order.
+        """
+        if self.frozen:
+            starts = self.offsets[buckets].astype(np.int64)
+            nids = self.offsets[buckets + 1].astype(np.int64) - starts
+        else:
+            nids = np.minimum(self.depth, self.counts[buckets])
+        rowix = np.repeat(np.arange(len(buckets)), nids)
+        slots = np.arange(len(rowix)) - np.repeat(np.cumsum(nids) - nids, nids)
+        if self.frozen:
+            vals = self.values[np.repeat(starts, nids) + slots]
+        else:
+            vals = self.table[buckets[rowix], slots]
+        return rowix, vals
+
     def save(self, name, params=None, file_object=None):
         """ Save hash table to file <name>,
-            including optional addition params
+            including optional addition params.
+            A name ending in HT_MMAP_EXT is written in the uncompressed,
+            memory-mappable format, one ending in HT_CHUNKED_EXT in the
+            chunked format, one ending in HT_SPARSE_EXT in the chunked
+            format with only the occupied buckets, otherwise as a gzipped
+            pickle.
         """
         # Merge in any provided params
         if params:
             for key in params:
                 self.params[key] = params[key]
-        if file_object:
-          f = file_object
+        if self.journal_file:
+            # A full save supersedes the journal
+            self.close_journal()
+        # Any journal left on disk is stale once this save completes
+        self.journal_end = None
+        # A fresh tag means any journal written against the previous
+        # version of the file will no longer be replayed over this one.
+        self.params['journal_tag'] = os.urandom(8).hex()
+        ext = os.path.splitext(name)[1]
+        if file_object is None and ext == HT_MMAP_EXT:
+            self.save_mmap(name)
+        elif file_object is None and ext == HT_CHUNKED_EXT:
+            self.save_chunked(name)
+        elif file_object is None and ext == HT_SPARSE_EXT:
+            self.save_chunked(name, sparse=True)
         else:
-          f = gzip.open(name, 'wb')
-        pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+            if file_object:
+              f = file_object
+            else:
+              # Written under a temporary name and then renamed, so an
+              # interrupted save leaves the previous file intact
+              f = gzip.open(name + '.tmp', 'wb')
+            # A header that open_metadata can read without the table
+            header = self._header_to_save()
+            header['hashesperid'] = self.hashesperid
+            f.write(HT_PKL_MAGIC)
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+            if not file_object:
+              f.close()
+              os.replace(name + '.tmp', name)
         self.dirty = False
-        nhashes = sum(self.counts)
+        if file_object is None and os.path.exists(name + HT_JOURNAL_EXT):
+            # Its updates are now part of the saved table
+            os.remove(name + HT_JOURNAL_EXT)
+        nhashes = np.sum(self.counts)
         # Report the proportion of dropped hashes (overfull table)
-        dropped = nhashes - sum(np.minimum(self.depth, self.counts))
+        dropped = nhashes - np.sum(np.minimum(self.depth, self.counts))
         print("Saved fprints for", sum(n is not None for n in self.names),
               "files (", nhashes, "hashes) to", name,
               "(%.2f%% dropped)" % (100.0*dropped/max(1, nhashes)))
 
-    def load(self, name):
-        """ Read either pklz or mat-format hash table file """
+    def _header_to_save(self):
+        """ Everything but the big arrays, for the mmap and chunked
+            formats and the header of the pklz format. """
+        return {'ht_version': self.ht_version,
+                'hashbits': self.hashbits,
+                'depth': self.depth,
+                'maxtimebits': self.maxtimebits,
+                'names': self.names,
+                'labels': self.labels,
+                'stop_count': self.stop_count,
+                'params': self.params}
+
+    def _arrays_to_save(self, sparse=False):
+        """ The (key, array) pairs written by the mmap and chunked formats
+            and read back by _restore.  If sparse, the table is written as
+            the list of occupied buckets, their counts and just their
+            stored entries, so the size depends only on the number of
+            hashes stored and not on 2^hashbits x depth. """
+        if sparse:
+            buckets = np.flatnonzero(self.counts)
+            if self.frozen:
+                # values already holds just the occupied entries, in order
+                values = self.values
+            else:
+                _, values = self._bucket_entries(buckets)
+            arrays = [('sparse_buckets', buckets.astype(np.uint32)),
+                      ('sparse_counts', self.counts[buckets]),
+                      ('values', np.ascontiguousarray(values))]
+        elif self.frozen:
+            arrays = [('offsets', np.ascontiguousarray(self.offsets)),
+                      ('values', np.ascontiguousarray(self.values))]
+        else:
+            arrays = [('table', np.ascontiguousarray(self.table))]
+        if not sparse:
+            # (sparse_counts stands in for the full counts)
+            arrays += [('counts', np.ascontiguousarray(self.counts))]
+        arrays += [('hashesperid', np.ascontiguousarray(self.hashesperid))]
+        if self.id_buckets is not None:
+            # Pack the per-id bucket lists end to end
+            idindex_offsets = np.zeros(len(self.id_buckets) + 1, np.int64)
+            np.cumsum([len(b) for b in self.id_buckets],
+                      out=idindex_offsets[1:])
+            arrays += [('idindex_offsets', idindex_offsets),
+                       ('idindex_buckets',
+                        np.concatenate([np.zeros(0, np.uint32)]
+                                       + list(self.id_buckets)))]
+        return arrays
+
+    def _restore(self, name, header, arrays):
+        """ Set up from a header written by _header_to_save and a dict of
+            the arrays from _arrays_to_save (which may be memory-mapped). """
+        if header['ht_version'] < HT_COMPAT_VERSION:
+          raise ValueError('Version of ' + name + ' is '
+                           + str(header['ht_version'])
+                           + ' which is not at least ' + str(HT_COMPAT_VERSION))
+        self.hashbits = header['hashbits']
+        self.depth = header['depth']
+        self.maxtimebits = header['maxtimebits']
+        self.ht_version = header['ht_version']
+        self.names = header['names']
+        self.labels = header['labels']
+        self.stop_count = header.get('stop_count')
+        self._index_names()
+        self.params = header['params']
+        self.frozen = 'values' in arrays
+        if 'sparse_buckets' in arrays:
+            # Rebuild the counts, then the offsets of the compact layout
+            # from the number stored in each bucket.
+            self.counts = np.zeros(1 << self.hashbits, dtype=np.int32)
+            self.counts[arrays['sparse_buckets']] = arrays['sparse_counts']
+            self.table = None
+            self.offsets = self._packed_offsets()
+            self.values = arrays['values']
+        elif self.frozen:
+            self.table = None
+            self.offsets = arrays['offsets']
+            self.values = arrays['values']
+            self.counts = arrays['counts']
+        else:
+            self.table = arrays['table']
+            self.counts = arrays['counts']
+        # hashesperid is small and grows as names are added; read it in
+        self.hashesperid = np.array(arrays['hashesperid'])
+        if 'idindex_offsets' in arrays:
+            idindex_offsets = arrays['idindex_offsets']
+            idindex_buckets = arrays['idindex_buckets']
+            self.id_buckets = [idindex_buckets[start:end] for start, end
+                               in zip(idindex_offsets[:-1],
+                                      idindex_offsets[1:])]
+        else:
+            self.id_buckets = None
+        self.dirty = False
+
+    def save_chunked(self, name, codec='zlib', nthreads=None, sparse=False):
+        """ Write the hash table as independently-compressed blocks of
+            about HT_CHUNK_BYTES each, compressed in parallel by a thread
+            pool (zlib and lzma release the GIL), followed by a pickled
+            header indexing the blocks.  Tables are split by rows, i.e.
+            by ranges of hash values, which read_chunked_rows and the
+            hashrange option of load_chunked can read on their own.
+            sparse writes only the occupied buckets (see _arrays_to_save).
+        """
+        compress = HT_CHUNK_CODECS[codec][0]
+        arrays = self._arrays_to_save(sparse)
+        header = self._header_to_save()
+        header['codec'] = codec
+        # Cut every array into blocks of whole rows
+        blocks = []
+        for key, array in arrays:
+            rowbytes = max(1, array[:1].nbytes)
+            rows = max(1, HT_CHUNK_BYTES // rowbytes)
+            for start in range(0, len(array), rows):
+                blocks.append((key, start, min(len(array), start + rows)))
+        arraydict = dict(arrays)
+        def compress_block(block):
+            key, start, end = block
+            return compress(arraydict[key][start:end].tobytes())
+        header['arrays'] = {key: (array.dtype.str, array.shape, [])
+                            for key, array in arrays}
+        tmpname = name + '.tmp'
+        with open(tmpname, 'wb') as f, \
+             concurrent.futures.ThreadPoolExecutor(nthreads) as pool:
+            f.write(HT_CHUNKED_MAGIC)
+            # Placeholder for the offset of the header
+            f.write(struct.pack('<Q', 0))
+            for (key, start, end), data in zip(
+                    blocks, pool.map(compress_block, blocks)):
+                header['arrays'][key][2].append((start, end, f.tell(),
+                                                 len(data)))
+                f.write(data)
+            headeroffset = f.tell()
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            f.seek(len(HT_CHUNKED_MAGIC))
+            f.write(struct.pack('<Q', headeroffset))
+        os.replace(tmpname, name)
+
+    def load_chunked(self, name, hashrange=None, nthreads=None):
+        """ Read a hash table written by save_chunked, decompressing its
+            blocks in parallel.  hashrange = (start, end) reads only the
+            table rows and counts for those hash values, leaving the rest
+            of the table empty (so other hashes find no hits).
+        """
+        with open(name, 'rb') as f:
+            header = _read_chunked_header(f, name)
+            specs = header['arrays']
+            if hashrange is not None and 'table' not in specs:
+                raise ValueError("hashrange needs a dense saved table")
+            arrays = {}
+            with concurrent.futures.ThreadPoolExecutor(nthreads) as pool:
+                for key in specs:
+                    if hashrange is not None and (key == 'table'
+                                                  or key == 'counts'):
+                        start, end = hashrange
+                    else:
+                        start, end = None, None
+                    arrays[key] = _read_chunked_array(
+                        f, specs[key], header['codec'], pool, start, end)
+        self._restore(name, header, arrays)
+
+    def save_mmap(self, name):
+        """ Write the hash table as a small pickled header followed by
+            the raw table, counts and hashesperid arrays, each starting on
+            a page boundary so that load_mmap can map them directly.
+            The file is written under a temporary name and then renamed,
+            so processes that have the old file mapped are unaffected.
+        """
+        arrays = self._arrays_to_save()
+        header = self._header_to_save()
+        # The array offsets are stored in the header, so grow the space
+        # reserved for the header until it fits.
+        datastart = HT_MMAP_ALIGN
+        while True:
+            layout = {}
+            offset = datastart
+            for key, array in arrays:
+                layout[key] = (offset, array.dtype.str, array.shape)
+                offset = _align(offset + array.nbytes)
+            header['arrays'] = layout
+            headerbytes = pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+            headerend = len(HT_MMAP_MAGIC) + 8 + len(headerbytes)
+            if headerend <= datastart:
+                break
+            datastart = _align(headerend)
+        tmpname = name + '.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(HT_MMAP_MAGIC)
+            f.write(struct.pack('<Q', len(headerbytes)))
+            f.write(headerbytes)
+            for key, array in arrays:
+                f.seek(layout[key][0])
+                array.tofile(f)
+        os.replace(tmpname, name)
+
+    def load(self, name, frozen=None):
+        """ Read a pklz, mat-format, memory-mappable or chunked hash table,
+            then replay any journal of updates written alongside it.
+            frozen=True or False converts the table to the compact or the
+            dense layout; by default it stays in the layout it was saved
+            in (the compact one, for a sparse file). """
+        self.journal_file = None
+        self.lazy_name = None
         ext = os.path.splitext(name)[1]
         if ext == '.mat':
             self.load_matlab(name)
         else:
-            self.load_pkl(name)
-        nhashes = sum(self.counts)
+            with open(name, 'rb') as f:
+                magic = f.read(len(HT_MMAP_MAGIC))
+            if magic == HT_MMAP_MAGIC:
+                self.load_mmap(name)
+            elif magic == HT_CHUNKED_MAGIC:
+                self.load_chunked(name)
+            else:
+                self.load_pkl(name)
+        self.journal_end = None
+        if os.path.exists(name + HT_JOURNAL_EXT):
+            self.journal_end = self.replay_journal(name + HT_JOURNAL_EXT)
+        if frozen:
+            self.freeze()
+        elif frozen is not None:
+            self.thaw()
+        nhashes = np.sum(self.counts)
         # Report the proportion of dropped hashes (overfull table)
-        dropped = nhashes - sum(np.minimum(self.depth, self.counts))
+        dropped = nhashes - np.sum(np.minimum(self.depth, self.counts))
         print("Read fprints for", sum(n is not None for n in self.names),
               "files (", nhashes, "hashes) from", name,
               "(%.2f%% dropped)" % (100.0*dropped/max(1, nhashes)))
 
+    def open_metadata(self, name):
+        """ Read just the names, labels, hashesperid and params of a saved
+            hash table, leaving the table itself to be loaded in full the
+            first time it is used (e.g. by get_hits, store or save).  Only
+            the header is read from mmap, chunked and pklz files, so this
+            takes milliseconds whatever the size of the table.  Files with
+            no separate header (mat files and older pklz files), and any
+            with a journal to replay, are loaded in full straight away.
+        """
+        header = None
+        if not os.path.exists(name + HT_JOURNAL_EXT):
+            header = _read_metadata(name)
+        if header is None:
+            self.load(name)
+            return
+        if header['ht_version'] < HT_COMPAT_VERSION:
+          raise ValueError('Version of ' + name + ' is '
+                           + str(header['ht_version'])
+                           + ' which is not at least ' + str(HT_COMPAT_VERSION))
+        for attr in HT_LAZY_ATTRS:
+            self.__dict__.pop(attr, None)
+        self.journal_file = None
+        self.journal_end = None
+        self.hashbits = header['hashbits']
+        self.depth = header['depth']
+        self.maxtimebits = header['maxtimebits']
+        self.ht_version = header['ht_version']
+        self.names = header['names']
+        self.labels = header['labels']
+        self.stop_count = header.get('stop_count')
+        self._index_names()
+        self.params = header['params']
+        self.hashesperid = np.array(header['hashesperid'])
+        self.dirty = False
+        self.lazy_name = name
+        print("Read metadata for", sum(n is not None for n in self.names),
+              "files (", np.sum(self.hashesperid), "hashes) from", name)
+
+    def _load_lazy(self):
+        """ Read the table deferred by open_metadata, keeping any changes
+            already made to the names, labels or params. """
+        name = self.lazy_name
+        keep = {attr: self.__dict__[attr]
+                for attr in ('names', 'labels', 'params', 'hashesperid',
+                             'stop_count', 'dirty', 'journal_file')}
+        self.load(name)
+        self.__dict__.update(keep)
+        self._index_names()
+
+    def open_journal(self, name):
+        """ Start appending every subsequent store, merge and remove to the
+            journal next to dbase file <name> (which this table was read
+            from), instead of rewriting the whole file with save().  The
+            journal is replayed by load(), and folded into the dbase (and
+            deleted) by the next save(). """
+        journalname = name + HT_JOURNAL_EXT
+        tag = self.params.get('journal_tag')
+        if self.journal_end is not None and os.path.exists(journalname):
+            # load() replayed it, so it belongs to this table; add to it,
+            # after the last complete record
+            self.journal_file = open(journalname, 'r+b')
+            self.journal_file.truncate(self.journal_end)
+            self.journal_file.seek(self.journal_end)
+        else:
+            # Start afresh, replacing any stale journal (e.g. from a save
+            # interrupted before it could delete the journal)
+            self.journal_file = open(journalname, 'wb')
+            pickle.dump((HT_JOURNAL_MAGIC, tag), self.journal_file,
+                        pickle.HIGHEST_PROTOCOL)
+
+    def close_journal(self):
+        """ Stop journaling.  The journaled updates count as saved. """
+        if self.journal_file:
+            self.journal_file.close()
+            self.journal_file = None
+            self.dirty = False
+
+    def _journal(self, record):
+        """ Append one record to the journal, flushed so that a crash loses
+            at most the record being written. """
+        pickle.dump(record, self.journal_file, pickle.HIGHEST_PROTOCOL)
+        self.journal_file.flush()
+
+    def replay_journal(self, journalname):
+        """ Apply the updates recorded in a journal file.  The journal is
+            ignored if it was written against a different save of the
+            dbase, and a truncated final record is skipped.  Return the
+            offset just past the last record applied, or None if the
+            journal was ignored. """
+        nrecords = 0
+        with open(journalname, 'rb') as f:
+            magic, tag = pickle.load(f)
+            if magic != HT_JOURNAL_MAGIC:
+                raise IOError('%s is not a journal file (magic %s)'
+                              % (journalname, magic))
+            if tag != self.params.get('journal_tag'):
+                print("Ignoring stale journal", journalname)
+                return None
+            end = f.tell()
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    print("Skipping truncated record at end of", journalname)
+                    break
+                if record[0] == 'store':
+                    self.store(record[1], record[2])
+                elif record[0] == 'remove':
+                    self.remove(record[1])
+                else:
+                    raise ValueError("unknown journal record " + record[0])
+                nrecords += 1
+                end = f.tell()
+        # The table now matches what is on disk
+        self.dirty = False
+        print("Replayed", nrecords, "updates from", journalname)
+        return end
+
+    def load_mmap(self, name):
+        """ Open a hash table written by save_mmap.  The table and counts
+            are memory-mapped copy-on-write rather than read, so opening is
+            near-instant and every process mapping the same file shares one
+            copy in the page cache.  Changes (e.g. from store) stay private
+            to this process until the table is saved again.
+        """
+        with open(name, 'rb') as f:
+            header = _read_mmap_header(f, name)
+        self._restore(name, header, {
+            key: _map_array(name, *spec)
+            for key, spec in header['arrays'].items()})
+
     def load_pkl(self, name, file_object=None):
         """ Read hash table values from pickle file <name>. """
         if file_object:
           f = file_object
         else:
           f =  gzip.open(name, 'rb')
+        start = f.tell()
+        if f.read(len(HT_PKL_MAGIC)) == HT_PKL_MAGIC:
+            # Skip the metadata header (see open_metadata)
+            pickle.load(f)
+        else:
+            # Written before pklz files had a header
+            f.seek(start)
         temp = pickle.load(f)
         if temp.ht_version < HT_OLD_COMPAT_VERSION:
           raise ValueError('Version of ' + name + ' is ' + str(temp.ht_version)
@@ -224,9 +944,18 @@ class HashTable(object):
               temp.table != 0)
           temp.ht_version = HT_VERSION
         self.table = temp.table
+        # Tables pickled before freeze() existed are never frozen
+        self.frozen = getattr(temp, 'frozen', False)
+        if self.frozen:
+            self.offsets = temp.offsets
+            self.values = temp.values
+        self.id_buckets = getattr(temp, 'id_buckets', None)
+        self.stop_count = getattr(temp, 'stop_count', None)
         self.ht_version = temp.ht_version
         self.counts = temp.counts
         self.names = temp.names
+        self.labels = getattr(temp, 'labels', [None] * len(self.names))
+        self._index_names()
         self.hashesperid = np.array(temp.hashesperid).astype(np.uint32)
         self.dirty = False
         self.params = params
@@ -260,9 +989,14 @@ class HashTable(object):
         # Python doesn't support the (pointless?) jenkins hashing
         assert params['nojenkins']
         self.table = mht['HashTable'].T
+        self.frozen = False
+        self.id_buckets = None
+        self.stop_count = None
         self.counts = mht['HashTableCounts'][0]
         self.names = [str(val[0]) if len(val) > 0 else []
                       for val in mht['HashTableNames'][0]]
+        self.labels = [None] * len(self.names)
+        self._index_names()
         self.hashesperid = np.array(mht['HashTableLengths'][0]).astype(np.uint32)
         # Matlab uses 1-origin for the IDs in the hashes, but the Python code
         # also skips using id_ 0, so that names[0] corresponds to id_ 1.
@@ -274,56 +1008,239 @@ class HashTable(object):
         """ Return the total count of hashes stored in the table """
         return np.sum(self.counts)
 
+    def set_stop_count(self, stop_count):
+        """ Treat buckets that have been offered more than stop_count
+            hashes as stop hashes, which get_hits skips: a hash that common
+            says little about which item matched, yet brings up to depth
+            hits to sort through.  Since counts keeps the total offered to
+            each bucket (not just the depth kept), the stop list follows
+            the table as it grows.  None uses every bucket again. """
+        self.stop_count = stop_count
+        self.dirty = True
+
+    def stop_hashes(self):
+        """ Return the hash values that get_hits currently skips. """
+        if self.stop_count is None:
+            return np.zeros(0, np.int64)
+        return np.flatnonzero(self.counts > self.stop_count)
+
+    def bucket_stats(self):
+        """ Return a dict describing how full the buckets are: how many
+            are occupied, have overflowed depth (so have been randomly
+            subsampled), or are stop hashes, and the hashes in each. """
+        counts = self.counts
+        stored = np.minimum(self.depth, counts)
+        stop = self.stop_hashes()
+        return {'buckets': len(counts),
+                'occupied_buckets': int(np.count_nonzero(counts)),
+                'overflowed_buckets': int(np.sum(counts > self.depth)),
+                'stop_buckets': len(stop),
+                'hashes': int(np.sum(counts)),
+                'stored_hashes': int(np.sum(stored)),
+                'dropped_hashes': int(np.sum(counts - stored)),
+                'stop_stored_hashes': int(np.sum(stored[stop])),
+                'max_count': int(np.max(counts)) if len(counts) else 0,
+                'stop_count': self.stop_count}
+
+    def _entries_per_id(self):
+        """ Count the entries actually stored for each id, reading a block
+            of buckets at a time to bound the memory used. """
+        nentries = np.zeros(len(self.names) + 1, np.int64)
+        step = max(1, HT_CHUNK_BYTES // (4 * self.depth))
+        for start in range(0, len(self.counts), step):
+            _, vals = self._bucket_entries(
+                np.arange(start, min(len(self.counts), start + step)))
+            # Stored ids start from 1
+            nentries += np.bincount((vals >> self.maxtimebits).astype(np.int64),
+                                    minlength=len(nentries))
+        return nentries[1:]
+
+    def stats(self):
+        """ Return bucket_stats() plus
+              occupancy_histogram : the number of buckets holding each
+                number of entries from 0 to depth
+              dropped_per_id : the fraction of each id's hashes that were
+                dropped from overflowing buckets
+              hits_per_hash : the hits get_hits is expected to return for
+                each query hash, if the query hashes are distributed like
+                the stored ones; hits_per_random_hash for uniform ones
+              memory_bytes : the size of the arrays as currently laid out;
+                dense_bytes and compact_bytes as unfrozen and frozen
+        """
+        stats = self.bucket_stats()
+        stored = np.minimum(self.depth, self.counts)
+        stats['occupancy_histogram'] = np.bincount(stored,
+                                                   minlength=self.depth + 1)
+        hashesperid = self.hashesperid.astype(float)
+        stats['dropped_per_id'] = np.where(
+            hashesperid > 0,
+            1.0 - self._entries_per_id() / np.maximum(1.0, hashesperid), 0.0)
+        usable = stored.astype(float)
+        usable[self.stop_hashes()] = 0
+        stats['hits_per_hash'] = (np.sum(self.counts * usable)
+                                  / max(1, stats['hashes']))
+        stats['hits_per_random_hash'] = np.mean(usable)
+        if self.frozen:
+            arrays = [self.offsets, self.values]
+        else:
+            arrays = [self.table]
+        stats['memory_bytes'] = sum(array.nbytes for array in arrays
+                                    + [self.counts, self.hashesperid])
+        nbuckets = len(self.counts)
+        entrybytes = self.entrybits // 8
+        stats['dense_bytes'] = nbuckets * (entrybytes * self.depth + 4)
+        stats['compact_bytes'] = (entrybytes * stats['stored_hashes']
+                                  + 4 * (2 * nbuckets + 1))
+        return stats
+
+    def print_stats(self, print_fn=None):
+        """ Report stats() in readable form. """
+        if not print_fn:
+            print_fn = print
+        stats = self.stats()
+        nbuckets = stats['buckets']
+        print_fn("%d buckets (%d hashbits) of depth %d: %.1f%% occupied, "
+                 "%.1f%% overflowed, %d stop hashes"
+                 % (nbuckets, self.hashbits, self.depth,
+                    100.0 * stats['occupied_buckets'] / nbuckets,
+                    100.0 * stats['overflowed_buckets'] / nbuckets,
+                    stats['stop_buckets']))
+        print_fn("%d hashes offered, %d stored, %.2f%% dropped"
+                 % (stats['hashes'], stats['stored_hashes'],
+                    100.0 * stats['dropped_hashes'] / max(1, stats['hashes'])))
+        print_fn("Entries per bucket:")
+        histogram = stats['occupancy_histogram']
+        width = max(1, self.depth // 10)
+        for lo in range(0, self.depth, width):
+            hi = min(self.depth - 1, lo + width - 1)
+            print_fn("  %5d-%-5d %9d buckets" % (lo, hi,
+                                                  np.sum(histogram[lo:hi + 1])))
+        print_fn("  %5d (full) %8d buckets" % (self.depth, histogram[-1]))
+        dropped_per_id = stats['dropped_per_id']
+        ids = [id_ for id_, name in enumerate(self.names) if name is not None]
+        if ids:
+            worst = max(ids, key=lambda id_: dropped_per_id[id_])
+            print_fn("Dropped per file: %.2f%% mean, %.2f%% max (%s)"
+                     % (100.0 * np.mean(dropped_per_id[ids]),
+                        100.0 * dropped_per_id[worst], self.names[worst]))
+        print_fn("Expected hits per query hash: %.1f (%.1f for random hashes)"
+                 % (stats['hits_per_hash'], stats['hits_per_random_hash']))
+        print_fn("Memory: %.1f MB as loaded, %.1f MB dense, %.1f MB compact"
+                 % (stats['memory_bytes'] / 1e6, stats['dense_bytes'] / 1e6,
+                    stats['compact_bytes'] / 1e6))
+
     def merge(self, ht):
         """ Merge in the results from another hash table """
         # All the items go into our table, offset by our current size
         # Check compatibility
         assert self.maxtimebits == ht.maxtimebits
+        if self.frozen:
+            self.thaw()
         ncurrent = len(self.names)
+        self._check_ids(ncurrent + len(ht.names))
+        if self.journal_file:
+            self._journal_table(ht)
         #size = len(self.counts)
         self.names += ht.names
+        self.labels += ht.labels
+        self._index_names()
         self.hashesperid = np.append(self.hashesperid, ht.hashesperid)
+        if self.id_buckets is not None:
+            if ht.id_buckets is None:
+                ht.build_index()
+            self.id_buckets += ht.id_buckets
         # Shift all the IDs in the second table down by ncurrent
         idoffset = (1 << self.maxtimebits) * ncurrent
-        for hash_ in np.nonzero(ht.counts)[0]:
-            allvals = np.r_[self.table[hash_, :self.counts[hash_]],
-                            ht.table[hash_, :ht.counts[hash_]] + idoffset]
-            # ht.counts[hash_] may be more than the actual number of
-            # hashes we obtained, if ht.counts[hash_] > ht.depth.
-            # Subselect based on actual size.
-            if len(allvals) > self.depth:
-                # Our hash bin is filled: randomly subselect the
-                # hashes, and update count to accurately track the
-                # total number of hashes we've seen for this bin.
-                somevals = np.random.permutation(allvals)[:self.depth]
-                self.table[hash_, ] = somevals
-                self.counts[hash_] += ht.counts[hash_]
-            else:
-                # Our bin isn't full.  Store all the hashes, and
-                # accurately track how many values it contains.  This
-                # may mean some of the hashes counted for full buckets
-                # in ht are "forgotten" if ht.depth < self.depth.
-                self.table[hash_, :len(allvals)] = allvals
-                self.counts[hash_] = len(allvals)
-
+        buckets = np.nonzero(ht.counts)[0]
+        # Gather every stored entry for the affected buckets from both
+        # tables, ours first.  ht.counts[hash_] may be more than the actual
+        # number of hashes we obtained, if ht.counts[hash_] > ht.depth,
+        # so _bucket_entries subselects based on actual size.
+        ourrows, ourvals = self._bucket_entries(buckets)
+        theirrows, theirvals = ht._bucket_entries(buckets)
+        rowix = np.r_[ourrows, theirrows]
+        entrytype = self.table.dtype.type
+        allvals = np.r_[ourvals,
+                        theirvals.astype(entrytype) + entrytype(idoffset)]
+        nvals = np.bincount(rowix, minlength=len(buckets))
+        full = nvals > self.depth
+        # Our hash bin is filled: randomly subselect the hashes by sorting
+        # its entries on random keys and keeping the first depth of them.
+        # Bins that aren't full keep their entries in order.
+        sortkey = np.arange(len(rowix), dtype=float)
+        randomize = full[rowix]
+        sortkey[randomize] = np.random.random_sample(np.sum(randomize))
+        order = np.lexsort((sortkey, rowix))
+        rowix = rowix[order]
+        allvals = allvals[order]
+        slots = np.arange(len(rowix)) - np.repeat(np.cumsum(nvals) - nvals,
+                                                   nvals)
+        keep = slots < self.depth
+        self.table[buckets[rowix[keep]], slots[keep]] = allvals[keep]
+        # For filled bins, update count to accurately track the total
+        # number of hashes we've seen for this bin.  Otherwise the bin
+        # holds all the hashes, and we record how many values it contains.
+        # This may mean some of the hashes counted for full buckets in ht
+        # are "forgotten" if ht.depth < self.depth.
+        self.counts[buckets] = np.where(
+            full, self.counts[buckets] + ht.counts[buckets], nvals)
         self.dirty = True
 
+    def _journal_table(self, ht):
+        """ Journal the contents of another table being merged into this
+            one, as one store record per name. """
+        buckets = np.arange(len(ht.counts))
+        rowix, vals = ht._bucket_entries(buckets)
+        ids = (vals >> ht.maxtimebits).astype(np.int64) - 1
+        order = np.argsort(ids, kind='mergesort')
+        timehashpairs = np.c_[vals[order] & ((1 << ht.maxtimebits) - 1),
+                              rowix[order]].astype(np.int32)
+        bounds = np.searchsorted(ids[order], np.arange(len(ht.names) + 1))
+        for id_, name in enumerate(ht.names):
+            if name is not None:
+                self._journal(('store', name,
+                               timehashpairs[bounds[id_]:bounds[id_ + 1]]))
+
+    def _index_names(self):
+        """ Rebuild the name -> id dict and the heap of free (removed) ids
+            from the names list. """
+        self.name_ids = {}
+        self.free_ids = []
+        for id_, name in enumerate(self.names):
+            if name is None:
+                self.free_ids.append(id_)
+            elif isinstance(name, str):
+                # Duplicate names resolve to the first, like names.index()
+                self.name_ids.setdefault(name, id_)
+        # free_ids was built in increasing order, so it is already a heap
+
     def name_to_id(self, name, add_if_missing=False):
-        """ Lookup name in the names list, or optionally add. """
+        """ Lookup name in the names registry, or optionally add. """
         if isinstance(name, str):
             # lookup name or assign new
-            if name not in self.names:
+            id_ = self.name_ids.get(name)
+            if id_ is None:
                 if not add_if_missing:
                     raise ValueError("name " + name + " not found")
-                # Use an empty slot in the list if one exists.
-                try:
-                    id_ = self.names.index(None)
+                # Use the lowest empty slot in the list if one exists.
+                id_ = self.free_ids[0] if self.free_ids else len(self.names)
+                # Check before registering, so a name that doesn't fit
+                # isn't left behind with no hashes
+                self._check_ids(id_ + 1)
+                if self.free_ids:
+                    heapq.heappop(self.free_ids)
                     self.names[id_] = name
+                    self.labels[id_] = None
                     self.hashesperid[id_] = 0
-                except ValueError:
+                    if self.id_buckets is not None:
+                        self.id_buckets[id_] = np.zeros(0, np.uint32)
+                else:
                     self.names.append(name)
+                    self.labels.append(None)
                     self.hashesperid = np.append(self.hashesperid, [0])
-            id_ = self.names.index(name)
+                    if self.id_buckets is not None:
+                        self.id_buckets.append(np.zeros(0, np.uint32))
+                self.name_ids[name] = id_
         elif isinstance(name, bytes):
             raise NotImplementedError()
         else:
@@ -331,45 +1248,150 @@ class HashTable(object):
             id_ = name
         return id_
 
-    def remove(self, name):
-        """ Remove all data for named entity from the hash table. """
-        id_ = self.name_to_id(name)
+    def set_label(self, name, label):
+        """ Attach a display label (such as the catalog object name) to a
+            stored name or id; look it up by id with self.labels[id_]. """
+        self.labels[self.name_to_id(name)] = label
+        self.dirty = True
+
+    def build_index(self):
+        """ Start maintaining an index of which buckets hold entries for
+            each id, so that remove and retrieve only visit those buckets.
+            The index is built from the current contents in one pass, then
+            kept up to date by store, merge and remove, and saved with the
+            table.  It may list buckets whose entries for an id have since
+            been displaced, but never misses one.
+        """
+        buckets = np.arange(len(self.counts))
+        rowix, vals = self._bucket_entries(buckets)
+        ids = (vals >> self.maxtimebits).astype(np.int64) - 1
+        # Group the bucket numbers by id, sorted within each id
+        order = np.lexsort((rowix, ids))
+        ids = ids[order]
+        rowix = rowix[order]
+        bounds = np.searchsorted(ids, np.arange(len(self.names) + 1))
+        self.id_buckets = [np.unique(rowix[start:end]).astype(np.uint32)
+                           for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def _buckets_containing(self, ids):
+        """ Return the sorted bucket numbers that (may) hold entries for
+            any of the ids, from the index if we have one, else by scanning
+            the whole table. """
+        if self.id_buckets is not None:
+            return np.unique(np.concatenate(
+                [np.zeros(0, np.uint32)]
+                + [self.id_buckets[id_] for id_ in ids])).astype(np.int64)
         # Top nybbles of table entries are id_ + 1 (to avoid all-zero entries)
-        id_in_table = (self.table >> self.maxtimebits) == id_ + 1
-        hashes_removed = 0
-        for hash_ in np.nonzero(np.max(id_in_table, axis=1))[0]:
-            vals = self.table[hash_, :self.counts[hash_]]
-            vals = [v for v, x in zip(vals, id_in_table[hash_])
-                    if not x]
-            self.table[hash_] = np.hstack([vals,
-                                           np.zeros(self.depth - len(vals))])
-            # This will forget how many extra hashes we had dropped until now.
-            self.counts[hash_] = len(vals)
-            hashes_removed += np.sum(id_in_table[hash_])
-        self.names[id_] = None
-        self.hashesperid[id_] = 0
+        idvals = np.asarray(ids, dtype=np.int64) + 1
+        if self.frozen:
+            idvals = idvals.astype(self.values.dtype)
+            positions = np.nonzero(np.isin(self.values >> self.maxtimebits,
+                                           idvals))[0]
+            return np.unique(np.searchsorted(self.offsets, positions,
+                                             side='right') - 1)
+        return np.nonzero(np.any(np.isin(self.table >> self.maxtimebits,
+                                         idvals.astype(self.table.dtype)),
+                                 axis=1))[0]
+
+    def remove(self, names):
+        """ Remove all data for a named entity, or a list of them, from the
+            hash table.  A list is cleared in a single pass over the
+            buckets holding any of its entries.
+        """
+        if isinstance(names, str):
+            names = [names]
+        if len(names) == 0:
+            return
+        if self.frozen:
+            self.thaw()
+        ids = [self.name_to_id(name) for name in names]
+        # Top nybbles of table entries are id_ + 1 (to avoid all-zero entries)
+        idvals = np.array(ids, dtype=np.int64) + 1
+        buckets = self._buckets_containing(ids)
+        rows = self.table[buckets]
+        occupied = (np.arange(self.depth) <
+                    np.minimum(self.depth, self.counts[buckets])[:, np.newaxis])
+        rowids = (rows >> self.maxtimebits).astype(np.int64)
+        drop = occupied & np.isin(rowids, idvals)
+        # Only rewrite the buckets that actually lose entries
+        changed = np.any(drop, axis=1)
+        buckets = buckets[changed]
+        rows = rows[changed]
+        keep = occupied[changed] & ~drop[changed]
+        # Slide the surviving entries down to the front of each bucket
+        order = np.argsort(~keep, axis=1, kind='mergesort')
+        rows = rows[np.arange(len(rows))[:, np.newaxis], order]
+        # This will forget how many extra hashes we had dropped until now.
+        newcounts = np.sum(keep, axis=1)
+        rows[np.arange(self.depth) >= newcounts[:, np.newaxis]] = 0
+        self.table[buckets] = rows
+        self.counts[buckets] = newcounts
+        hashes_removed = np.bincount(rowids[drop],
+                                     minlength=int(np.max(idvals)) + 1)
+        for name, id_ in zip(names, ids):
+            self.names[id_] = None
+            self.labels[id_] = None
+            self.hashesperid[id_] = 0
+            if self.id_buckets is not None:
+                self.id_buckets[id_] = np.zeros(0, np.uint32)
+            print("Removed", name, "(", hashes_removed[id_ + 1], "hashes).")
+        self._index_names()
+        if self.journal_file:
+            self._journal(('remove', list(names)))
         self.dirty = True
-        print("Removed", name, "(", hashes_removed, "hashes).")
 
     def retrieve(self, name):
         """Return an np.array of (time, hash) pairs found in the table."""
         id_ = self.name_to_id(name)
         maxtimemask = (1 << self.maxtimebits) - 1
-        num_hashes_per_hash = np.sum(
-            (self.table >> self.maxtimebits) == (id_ + 1), axis=1)
-        hashes_containing_id = np.nonzero(num_hashes_per_hash)[0]
-        timehashpairs = np.zeros((sum(num_hashes_per_hash), 2), dtype=np.int32)
-        hashes_so_far = 0
-        for hash_ in hashes_containing_id:
-            entries = self.table[hash_, :self.counts[hash_]]
-            matching_entries = np.nonzero(
-                (entries >> self.maxtimebits) == (id_ + 1))[0]
-            times = (entries[matching_entries] & maxtimemask)
-            timehashpairs[hashes_so_far : hashes_so_far + len(times), 0] = times
-            timehashpairs[hashes_so_far : hashes_so_far + len(times), 1] = hash_
-            hashes_so_far += len(times)
+        buckets = self._buckets_containing([id_])
+        rowix, entries = self._bucket_entries(buckets)
+        matching = np.nonzero((entries >> self.maxtimebits) == (id_ + 1))[0]
+        timehashpairs = np.zeros((len(matching), 2), dtype=self._hit_dtype())
+        timehashpairs[:, 0] = entries[matching] & maxtimemask
+        timehashpairs[:, 1] = buckets[rowix[matching]]
         return timehashpairs
 
+    def freeze(self):
+        """ Convert to the compact read-only layout: the occupied entries of
+            every bucket are packed end to end into self.values, and
+            self.offsets[hash_]:self.offsets[hash_ + 1] indexes the entries
+            for hash_.  For a sparsely-filled table this is one to two
+            orders of magnitude smaller than the dense table.  get_hits,
+            retrieve and list work unchanged; anything that modifies the
+            table thaw()s it back to the dense layout first.
+        """
+        if self.frozen:
+            return
+        # Gather only the occupied entries, bucket by bucket
+        _, self.values = self._bucket_entries(np.arange(len(self.counts)))
+        self.offsets = self._packed_offsets()
+        self.table = None
+        self.frozen = True
+
+    def _packed_offsets(self):
+        """ Offsets of each bucket's entries in the compact layout, from
+            the number stored in each bucket; uint32 where they fit. """
+        offsets = np.zeros(len(self.counts) + 1, dtype=np.int64)
+        np.cumsum(np.minimum(self.depth, self.counts), out=offsets[1:])
+        if offsets[-1] < (1 << 32):
+            offsets = offsets.astype(np.uint32)
+        return offsets
+
+    def thaw(self):
+        """ Rebuild the dense table from the compact layout. """
+        if not self.frozen:
+            return
+        offsets = self.offsets.astype(np.int64)
+        nids = np.diff(offsets)
+        self.table = np.zeros((len(nids), self.depth), dtype=self.values.dtype)
+        hashix = np.repeat(np.arange(len(nids)), nids)
+        slots = np.arange(len(self.values)) - np.repeat(offsets[:-1], nids)
+        self.table[hashix, slots] = self.values
+        del self.offsets
+        del self.values
+        self.frozen = False
+
     def list(self, print_fn=None):
         """ List all the known items. """
         if not print_fn:
@@ -87,6 +87,41 @@ def audios():
     return jsonify({"a": "b"})
 
 
+def _database_status():
+    database = audio_recognition_service.database
+    current = database.current
+    return {"version": current.version, "loaded_at": current.loaded_at, "loading": database.loading}
+
+
+def local_only(function):
+    @wraps(function)
+    def _inner_function(*args, **kw):
+        if request.remote_addr not in ("127.0.0.1", "::1"):
+            response = jsonify({"error message": "Forbidden."})
+            response.status_code = 403
+            return response
+        return function(*args, **kw)
+    return _inner_function
+
+
+@app.route('/admin/database')
+@local_only
+@catch_error
+def database_status():
+    return jsonify(_database_status())
+
+
+@app.route('/admin/database/reload', methods=['POST'])
+@local_only
+@catch_error
+def reload_database():
+    # Loads the new version in the background; poll /admin/database for its version
+    started = audio_recognition_service.database.reload()
+    result = _database_status()
+    result["started"] = started
+    return jsonify(result)
+
+
 def _main():
     server = pywsgi.WSGIServer(('127.0.0.1', 5000), app, handler_class=WebSocketHandler)
     server.serve_forever()
@@ -39,6 +39,16 @@ class AudioDataContainer(object):
     def get_audio_data_info(self, audio_file_name) -> AudioDataInfo:
         return self.__audio_file_name_dict.get(audio_file_name)
 
+    def label_hash_table(self, hash_table):
+        # Attach the object name of each audio file to its id in the hash table,
+        # so that match results can be labelled by id.
+        for id_, name in enumerate(hash_table.names):
+            if not isinstance(name, str):
+                continue
+            audio_data_info = self.get_audio_data_info(name.split("/")[-1])
+            if audio_data_info is not None:
+                hash_table.set_label(id_, audio_data_info.object_name)
+
 
 class AudioDataLoader(object):
 
@@ -14,6 +14,7 @@ from service.target_audios import path
 import os
 from audfprint.audfprint_match import MatchResult
 from service.audio_data_container import AudioDataLoader, AudioDataContainer, AudioDataInfo
+from service.fingerprint_database import FingerprintDatabase
 
 __author__ = "ujihirokazuya"
 __date__ = "2017/12/03"
@@ -24,6 +25,8 @@ SAMPLE_WIDTH = 2
 SAMPLE_RATE = 44100
 AUDIO_RANGE = 600
 # AUDIO_RANGE = 100
+# Seconds between checks for a new fingerprint database file (None to disable)
+DATABASE_POLL_INTERVAL = 30
 
 
 class AudioRecognitionService(object):
@@ -33,11 +36,31 @@ class AudioRecognitionService(object):
     def __init__(self):
         self._matcher = AudioPrintMatcher()
         self.__audio_data_container = AudioDataLoader().load()
+        hash_table = self._matcher.hash_table
+        self._label_hash_table(hash_table)
+        self.__database = FingerprintDatabase(self._matcher.dbasename, self._load_hash_table,
+                                              hash_table=hash_table, poll_interval=DATABASE_POLL_INTERVAL)
+        # The database handle owns the table from here on, so an old version isn't kept alive
+        self._matcher.hash_table = None
 
     @property
     def _audio_data_container(self) -> AudioDataContainer:
         return self.__audio_data_container
 
+    @property
+    def database(self) -> FingerprintDatabase:
+        return self.__database
+
+    def _label_hash_table(self, hash_table):
+        if not any(hash_table.labels):
+            # Database was built without labels, attach them from the tsv
+            self.__audio_data_container.label_hash_table(hash_table)
+
+    def _load_hash_table(self, file_path):
+        hash_table = self._matcher.load_hash_table(file_path)
+        self._label_hash_table(hash_table)
+        return hash_table
+
     def _create_file_name(self):
         suffix = str(uuid.uuid4())
         file_name = self._file_name_format.format(suffix)
@@ -48,17 +71,20 @@ class AudioRecognitionService(object):
         # os.remove(file_name)
         pass
 
-    def _get_object_name(self, file_names: List[str]):
-        if file_names is None:
+    @staticmethod
+    def _get_object_name(match_ids: List[int], hash_table):
+        if match_ids is None:
             return None
-        for file_name in file_names:
-            names = file_name.split("/")
-            audio_data_info = self._audio_data_container.get_audio_data_info(names[-1])
-            if audio_data_info is not None:
-                return audio_data_info.object_name
+        labels = hash_table.labels
+        for match_id in match_ids:
+            object_name = labels[match_id]
+            if object_name is not None:
+                return object_name
         return None
 
     def recognize(self, web_socket: WebSocket):
+        # Use one version of the database throughout, even if a reload finishes meanwhile
+        hash_table = self.__database.current.hash_table
         values = list()
         for i in range(AUDIO_RANGE):
             src = web_socket.receive()
@@ -83,14 +109,14 @@ class AudioRecognitionService(object):
         messages = list()
 
         def _report(result: MatchResult):
-            messages.append(result.match_file_names)
+            messages.append(result.match_ids)
 
-        self._matcher.execute(file_names, _report)
+        self._matcher.execute(file_names, _report, hash_tab=hash_table)
         self._delete_file(file_name)
         # flatten
         messages = list(chain.from_iterable(messages))
-        # messages = [audfprint/sound/cicada_abra.mp3]
-        object_name = self._get_object_name(messages)
+        # messages = [id of audfprint/sound/cicada_abra.mp3]
+        object_name = self._get_object_name(messages, hash_table)
         if object_name is None:
             send_message = "Not found"
         else:
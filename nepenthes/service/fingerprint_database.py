@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from typing import Callable
+
+import gevent
+from gevent import get_hub
+
+from audfprint.hash_table import HashTable
+from util.logging.log import logger
+
+
+class DatabaseVersion(object):
+    """One loaded version of the fingerprint database. Never modified once published."""
+
+    def __init__(self, version: int, hash_table: HashTable, mtime: float):
+        self.version = version
+        self.hash_table = hash_table
+        self.mtime = mtime
+        self.loaded_at = time.time()
+
+
+class FingerprintDatabase(object):
+    """Versioned handle to the fingerprint database file.
+
+    A reload builds the new HashTable in a native thread while requests keep matching against
+    the current version, then publishes it by swapping a single reference. A request should
+    read `current` once and use that version throughout, so ids and labels stay consistent.
+    """
+
+    def __init__(self, file_path: str, load_function: Callable[[str], HashTable], hash_table: HashTable = None,
+                 poll_interval: float = None):
+        self._file_path = file_path
+        self._load_function = load_function
+        self._loading = False
+        # mtime of a file that failed to load, so polling doesn't retry it every interval
+        self._failed_mtime = None
+        mtime = self._get_mtime()
+        if hash_table is None:
+            hash_table = load_function(file_path)
+        self.__current = DatabaseVersion(1, hash_table, mtime)
+        if poll_interval:
+            gevent.spawn(self._poll, poll_interval)
+
+    @property
+    def current(self) -> DatabaseVersion:
+        return self.__current
+
+    @property
+    def loading(self) -> bool:
+        return self._loading
+
+    def _get_mtime(self):
+        return os.stat(self._file_path).st_mtime
+
+    def reload(self) -> bool:
+        # Only called from greenlets, so the check and set can't interleave
+        if self._loading:
+            return False
+        self._loading = True
+        gevent.spawn(self._reload)
+        return True
+
+    def _reload(self):
+        mtime = None
+        try:
+            mtime = self._get_mtime()
+            # Load in the hub's native thread pool, so other greenlets keep serving requests
+            hash_table = get_hub().threadpool.apply(self._load_function, (self._file_path,))
+            version = self.__current.version + 1
+            self.__current = DatabaseVersion(version, hash_table, mtime)
+            self._failed_mtime = None
+            logger.info("Fingerprint database version {} loaded from {}".format(version, self._file_path))
+        except Exception as ex:
+            self._failed_mtime = mtime
+            logger.error("Failed to reload fingerprint database {}".format(self._file_path), exc_info=ex)
+        finally:
+            self._loading = False
+
+    def _poll(self, poll_interval: float):
+        last_mtime = None
+        while True:
+            gevent.sleep(poll_interval)
+            try:
+                mtime = self._get_mtime()
+            except OSError:
+                # Being replaced
+                continue
+            # Wait for the file to stop changing, in case it is still being written
+            if mtime == last_mtime and mtime != self.__current.mtime and mtime != self._failed_mtime:
+                self.reload()
+            last_mtime = mtime
@@ -0,0 +1,55 @@
+""" Regression tests for audfprint.hash_table; run from the nepenthes
+    directory with python -m pytest tests """
+
+import numpy as np
+
+from audfprint import hash_table
+
+
+def one_bucket_table(name, depth, nentries, entrybits=32):
+    """ A table holding nentries hashes for name, all in bucket 5 """
+    ht = hash_table.HashTable(hashbits=8, depth=depth, entrybits=entrybits)
+    ht.store(name, np.c_[np.arange(nentries), np.full(nentries, 5)])
+    return ht
+
+
+def test_merge_tables_into_deeper_table():
+    """ Intermediate merges must not truncate to the inputs' depth """
+    dest = hash_table.HashTable(hashbits=8, depth=100)
+    inputs = [one_bucket_table('f%d' % ix, 20, 15) for ix in range(4)]
+    hash_table.merge_tables([dest] + inputs)
+    assert dest.counts[5] == 60
+    assert np.sum(dest.table[5] != 0) == 60
+    assert dest.names == ['f0', 'f1', 'f2', 'f3']
+
+
+def test_merge_tables_matches_serial_merge():
+    """ A tree merge of equal-depth tables gives the serial result """
+    serial = hash_table.HashTable(hashbits=8, depth=100)
+    for ix in range(5):
+        serial.merge(one_bucket_table('f%d' % ix, 100, 15))
+    dest = hash_table.HashTable(hashbits=8, depth=100)
+    inputs = [one_bucket_table('f%d' % ix, 100, 15) for ix in range(5)]
+    hash_table.merge_tables([dest] + inputs, maxtables=2)
+    assert dest.names == serial.names
+    assert np.array_equal(dest.counts, serial.counts)
+    assert np.array_equal(dest.table, serial.table)
+
+
+def test_merge_tables_into_wider_entries():
+    """ 32-bit inputs merge into a 64-bit table as they would serially """
+    dest = hash_table.HashTable(hashbits=8, depth=100, entrybits=64)
+    inputs = [one_bucket_table('f%d' % ix, 100, 15) for ix in range(3)]
+    hash_table.merge_tables([dest] + inputs)
+    assert dest.table.dtype == np.uint64
+    assert dest.counts[5] == 45
+
+
+def test_remove_nothing():
+    """ Removing an empty list of names leaves the table as it was """
+    ht = one_bucket_table('f0', 20, 15)
+    ht.dirty = False
+    ht.remove([])
+    assert ht.names == ['f0']
+    assert ht.counts[5] == 15
+    assert not ht.dirty